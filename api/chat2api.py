@@ -1,7 +1,6 @@
-import asyncio
+import hashlib
 import types
 
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from fastapi import Request, HTTPException, Form, Security
 from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse
 from fastapi.security import HTTPAuthorizationCredentials
@@ -9,26 +8,53 @@ from starlette.background import BackgroundTask
 
 import utils.globals as globals
 from app import app, templates, security_scheme
-from chatgpt.ChatService import ChatService
-from chatgpt.authorization import refresh_all_tokens
+from chatgpt.ChatService import ChatService, sentinel_prefetcher
+from chatgpt.authorization import start_refresh_job, get_refresh_job
+from chatgpt.chatLimit import rate_limits
+from chatgpt.fp import get_fp, fp_store, fp_pool
+from chatgpt.proofofWork import pow_solver, start_dpl_refresh
+from chatgpt.refreshScheduler import refresh_scheduler
+from chatgpt.turnstile import shutdown_turnstile_executor
+from utils.Client import session_pool
 from utils.Logger import logger
-from utils.configs import api_prefix, scheduled_refresh
+from utils.configs import api_prefix, scheduled_refresh, chatgpt_base_url_list, refresh_on_startup, auto_seed
 from utils.retry import async_retry
 
-scheduler = AsyncIOScheduler()
-
-
 @app.on_event("startup")
 async def app_start():
+    fp_store.reconcile_all()
+    fp_pool.start()
+    fp = get_fp("").copy()
+    proxy_url = fp.pop("proxy_url", None)
+    impersonate = fp.pop("impersonate", "safari15_3")
+    host_url = chatgpt_base_url_list[0] if chatgpt_base_url_list else "https://chatgpt.com"
+    rate_limits.start()
+    globals.map_store.start()
+    start_dpl_refresh(host_url, fp, proxy_url.replace("{}", hashlib.md5(b"").hexdigest()) if proxy_url else None, impersonate)
+    if refresh_on_startup:
+        start_refresh_job(globals.token_registry.list())
     if scheduled_refresh:
-        scheduler.add_job(id='refresh', func=refresh_all_tokens, trigger='cron', hour=3, minute=0, day='*/2',
-                          kwargs={'force_refresh': True})
-        scheduler.start()
-        asyncio.get_event_loop().call_later(0, lambda: asyncio.create_task(refresh_all_tokens(force_refresh=False)))
+        refresh_scheduler.start()
+
+
+@app.on_event("shutdown")
+async def app_stop():
+    sentinel_prefetcher.stop()
+    fp_pool.stop()
+    rate_limits.stop()
+    refresh_scheduler.stop()
+    await session_pool.close()
+    if pow_solver:
+        pow_solver.shutdown()
+    shutdown_turnstile_executor()
+    await globals.map_store.stop()
 
 
 async def to_send_conversation(request_data, req_token):
-    chat_service = ChatService(req_token)
+    if not auto_seed:
+        # every token is looked up as a seed then, it must not miss one that is still loading
+        await globals.map_store.wait_loaded("seed_map")
+    chat_service = ChatService(req_token, model=request_data.get("model"))
     try:
         await chat_service.set_dynamic_data(request_data)
         await chat_service.get_chat_requirements()
@@ -44,9 +70,14 @@ async def to_send_conversation(request_data, req_token):
 
 async def process(request_data, req_token):
     chat_service = await to_send_conversation(request_data, req_token)
-    await chat_service.prepare_send_conversation()
-    res = await chat_service.send_conversation()
-    return chat_service, res
+    try:
+        await chat_service.prepare_send_conversation()
+        res = await chat_service.send_conversation()
+        return chat_service, res
+    except Exception:
+        # a retry starts a new service, this one must give back its session and scheduler slot
+        await chat_service.close_client()
+        raise
 
 
 @app.post(f"/{api_prefix}/v1/chat/completions" if api_prefix else "/v1/chat/completions")
@@ -76,9 +107,36 @@ async def send_conversation(request: Request, credentials: HTTPAuthorizationCred
         raise HTTPException(status_code=500, detail="Server error")
 
 
+@app.get(f"/{api_prefix}/health/live" if api_prefix else "/health/live")
+async def health_live():
+    return {"status": "ok"}
+
+
+@app.get(f"/{api_prefix}/health/ready" if api_prefix else "/health/ready")
+async def health_ready():
+    if not globals.map_store.is_ready():
+        return JSONResponse(status_code=503, content={"status": "loading", "pending": list(globals.map_store.loading)})
+    return {"status": "ready"}
+
+
+@app.get(f"/{api_prefix}/health/caches" if api_prefix else "/health/caches")
+async def health_caches():
+    caches = {
+        "refresh_map": globals.refresh_map,
+        "wss_map": globals.wss_map,
+        "fp_map": globals.fp_map,
+        "conversation_map": globals.conversation_map,
+        "fingerprints": fp_store.cache,
+    }
+    # the heap keeps superseded entries until they are popped, the table holds the live limits
+    rate_limits.evict()
+    return {"status": "success", "caches": {name: cache.stats() for name, cache in caches.items()},
+            "rate_limits": len(rate_limits.details)}
+
+
 @app.get(f"/{api_prefix}/tokens" if api_prefix else "/tokens", response_class=HTMLResponse)
 async def upload_html(request: Request):
-    tokens_count = len(set(globals.token_list) - set(globals.error_token_list))
+    tokens_count = len(globals.token_registry)
     return templates.TemplateResponse("tokens.html",
                                       {"request": request, "api_prefix": api_prefix, "tokens_count": tokens_count})
 
@@ -89,48 +147,76 @@ async def upload_post(text: str = Form(...)):
     for line in lines:
         if line.strip() and not line.startswith("#"):
             globals.token_list.append(line.strip())
-            with open(globals.TOKENS_FILE, "a", encoding="utf-8") as f:
-                f.write(line.strip() + "\n")
+            globals.token_registry.add(line.strip())
+            globals.map_store.mark_changed("token_list", line.strip())
     logger.info(f"Token count: {len(globals.token_list)}, Error token count: {len(globals.error_token_list)}")
-    tokens_count = len(set(globals.token_list) - set(globals.error_token_list))
+    tokens_count = len(globals.token_registry)
     return {"status": "success", "tokens_count": tokens_count}
 
 
+@app.post(f"/{api_prefix}/tokens/refresh" if api_prefix else "/tokens/refresh")
+async def refresh_tokens(text: str = Form(""), force: bool = Form(False)):
+    tokens = [line.strip() for line in text.split("\n") if line.strip() and not line.startswith("#")]
+    tokens = tokens or globals.token_registry.list()
+    job = get_refresh_job()
+    if job and job.finished is None and set(job.tokens) != set(tokens):
+        # one job runs at a time, a different token list is refused rather than dropped in favour of the running one
+        raise HTTPException(status_code=409, detail={"error": "Another refresh job is running, retry once it has finished",
+                                                     "progress": job.progress()})
+    job = start_refresh_job(tokens, force_refresh=force)
+    return StreamingResponse(job.stream(), media_type="application/x-ndjson")
+
+
+@app.get(f"/{api_prefix}/tokens/refresh" if api_prefix else "/tokens/refresh")
+async def refresh_tokens_progress():
+    job = get_refresh_job()
+    return {"status": "success", "progress": job.progress() if job else None}
+
+
 @app.post(f"/{api_prefix}/tokens/clear" if api_prefix else "/tokens/clear")
 async def clear_tokens():
     globals.token_list.clear()
     globals.error_token_list.clear()
-    with open(globals.TOKENS_FILE, "w", encoding="utf-8") as f:
-        pass
+    globals.token_registry.clear()
+    globals.map_store.mark_dirty("token_list")
     logger.info(f"Token count: {len(globals.token_list)}, Error token count: {len(globals.error_token_list)}")
-    tokens_count = len(set(globals.token_list) - set(globals.error_token_list))
+    tokens_count = len(globals.token_registry)
     return {"status": "success", "tokens_count": tokens_count}
 
 
 @app.post(f"/{api_prefix}/tokens/error" if api_prefix else "/tokens/error")
 async def error_tokens():
-    error_tokens_list = list(set(globals.error_token_list))
+    error_tokens_list = list(globals.token_registry.errors)
     return {"status": "success", "error_tokens": error_tokens_list}
 
 
+@app.get(f"/{api_prefix}/tokens/limits" if api_prefix else "/tokens/limits")
+async def token_limits(model: str = None):
+    if model:
+        limited = {token: clear_time for token, clear_time in rate_limits.limited_tokens(model).items()
+                   if token in globals.token_registry}
+        return {"status": "success", "model": model, "limited_tokens": limited,
+                "usable_count": len(globals.token_registry) - len(limited)}
+    rate_limits.evict()
+    return {"status": "success", "limits": rate_limits.details}
+
+
 @app.get(f"/{api_prefix}/tokens/add/{{token}}" if api_prefix else "/tokens/add/{token}")
 async def add_token(token: str):
     if token.strip() and not token.startswith("#"):
         globals.token_list.append(token.strip())
-        with open(globals.TOKENS_FILE, "a", encoding="utf-8") as f:
-            f.write(token.strip() + "\n")
+        globals.token_registry.add(token.strip())
+        globals.map_store.mark_changed("token_list", token.strip())
     logger.info(f"Token count: {len(globals.token_list)}, Error token count: {len(globals.error_token_list)}")
-    tokens_count = len(set(globals.token_list) - set(globals.error_token_list))
+    tokens_count = len(globals.token_registry)
     return {"status": "success", "tokens_count": tokens_count}
 
 
 @app.post(f"/{api_prefix}/seed_tokens/clear" if api_prefix else "/seed_tokens/clear")
 async def clear_seed_tokens():
+    await globals.map_store.wait_loaded("seed_map", "conversation_map")
     globals.seed_map.clear()
     globals.conversation_map.clear()
-    with open(globals.SEED_MAP_FILE, "w", encoding="utf-8") as f:
-        f.write("{}")
-    with open(globals.CONVERSATION_MAP_FILE, "w", encoding="utf-8") as f:
-        f.write("{}")
+    globals.map_store.mark_dirty("seed_map", "conversation_map")
     logger.info(f"Seed token count: {len(globals.seed_map)}")
     return {"status": "success", "seed_tokens_count": len(globals.seed_map)}
\ No newline at end of file
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import random
+import time
+import types
+
+from chatgpt import chatFormat, chatFormat_v1
+
+CONVERSATION_ID = "67d0c0de-0000-4000-8000-000000000000"
+
+
+def make_conversation(rng, chunks):
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "\n\n", "- item", "`code`", "中文", "🙂"]
+    text = lambda n: [rng.choice(words) + " " for _ in range(n)]
+    return [
+        {"role": "tool", "content_type": "text", "recipient": "all", "initial_text": "Searching", "chunks": text(8)},
+        {"role": "assistant", "content_type": "code", "recipient": "python", "chunks": text(16)},
+        {"role": "tool", "content_type": "execution_output", "recipient": "all", "chunks": text(4)},
+        {"role": "assistant", "content_type": "text", "recipient": "all", "chunks": text(chunks), "end_turn": True},
+    ]
+
+
+def make_message(index, spec, status, text):
+    content = {"content_type": spec["content_type"]}
+    if spec["content_type"] == "text":
+        content["parts"] = [text]
+    else:
+        content["text"] = text
+        if spec["content_type"] == "code":
+            content["language"] = "python"
+    return {
+        "id": f"message-{index}",
+        "author": {"role": spec["role"]},
+        "content": content,
+        "status": status,
+        "end_turn": None,
+        "recipient": spec["recipient"],
+        "metadata": {"initial_text": spec.get("initial_text", ""), "model_slug": "gpt-4o"},
+    }
+
+
+def legacy_lines(conversation):
+    for index, spec in enumerate(conversation):
+        text = ""
+        yield make_message(index, spec, "in_progress", text)
+        for chunk in spec["chunks"]:
+            text += chunk
+            yield make_message(index, spec, "in_progress", text)
+        message = make_message(index, spec, "finished_successfully", text)
+        message["end_turn"] = spec.get("end_turn", False)
+        yield message
+
+
+def encode_legacy(conversation):
+    for message in legacy_lines(conversation):
+        yield f"data: {json.dumps({'message': message, 'conversation_id': CONVERSATION_ID, 'error': None})}"
+        yield ""
+    yield "data: [DONE]"
+
+
+def encode_delta(conversation):
+    yield "event: delta_encoding"
+    yield 'data: "v1"'
+    yield ""
+    for index, spec in enumerate(conversation):
+        path = "/message/content/parts/0" if spec["content_type"] == "text" else "/message/content/text"
+        root = {"message": make_message(index, spec, "in_progress", ""), "conversation_id": CONVERSATION_ID, "error": None}
+        events = [{"p": "", "o": "add", "v": root, "c": index}]
+        for i, chunk in enumerate(spec["chunks"]):
+            events.append({"p": path, "o": "append", "v": chunk} if i == 0 else {"v": chunk})
+        events.append({"p": "", "o": "patch", "v": [
+            {"p": "/message/status", "o": "replace", "v": "finished_successfully"},
+            {"p": "/message/end_turn", "o": "replace", "v": spec.get("end_turn", False)},
+            {"p": "/message/metadata", "o": "append", "v": {"is_complete": True}},
+        ]})
+        for event in events:
+            yield "event: delta"
+            yield f"data: {json.dumps(event)}"
+            yield ""
+    yield 'data: {"type": "message_stream_complete", "conversation_id": "%s"}' % CONVERSATION_ID
+    yield ""
+    yield "data: [DONE]"
+
+
+async def lines(encoded):
+    for line in encoded:
+        yield line.encode("utf-8")
+
+
+async def translate(engine, encoded, max_tokens=10 ** 9):
+    service = types.SimpleNamespace(history_disabled=True)
+    response, start, delta = await chatFormat_v1.head_process_response(lines(encoded))
+    contents, finish_reasons = [], []
+    async for chunk in engine(service, response, "gpt-4o", max_tokens):
+        if chunk.startswith("data: {"):
+            choice = json.loads(chunk[6:])["choices"][0]
+            contents.append(choice["delta"].get("content", ""))
+            finish_reasons.append(choice["finish_reason"])
+    return start, delta, "".join(contents), [reason for reason in finish_reasons if reason]
+
+
+def check_conformance(samples=50, seed=0):
+    rng = random.Random(seed)
+    mismatches = 0
+    for _ in range(samples):
+        conversation = make_conversation(rng, rng.randint(0, 60))
+        legacy = asyncio.run(translate(chatFormat.stream_response, list(encode_legacy(conversation))))
+        delta = asyncio.run(translate(chatFormat_v1.stream_response, list(encode_delta(conversation))))
+        if legacy[0] != delta[0] or legacy[1] or not delta[1] or legacy[2:] != delta[2:]:
+            mismatches += 1
+    return mismatches
+
+
+def time_ms(engine, encoded):
+    start = time.perf_counter()
+    asyncio.run(translate(engine, encoded))
+    return (time.perf_counter() - start) * 1000
+
+
+if __name__ == "__main__":
+    mismatches = check_conformance()
+    print(f"conformance: {'ok' if not mismatches else f'{mismatches} mismatches'} (50 conversations)")
+    for chunks in (200, 1000, 4000):
+        conversation = make_conversation(random.Random(chunks), chunks)
+        legacy = list(encode_legacy(conversation))
+        delta = list(encode_delta(conversation))
+        before = time_ms(chatFormat.stream_response, legacy)
+        after = time_ms(chatFormat_v1.stream_response, delta)
+        legacy_bytes = sum(len(line) for line in legacy)
+        delta_bytes = sum(len(line) for line in delta)
+        print(f"{chunks:5} chunks  cumulative: {before:8.1f}ms {legacy_bytes / 1024:8.0f}KiB  "
+              f"delta: {after:6.1f}ms {delta_bytes / 1024:5.0f}KiB ({before / after:.1f}x)")
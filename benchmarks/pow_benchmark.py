@@ -0,0 +1,89 @@
+import hashlib
+import json
+import random
+import time
+import uuid
+
+import pybase64
+
+from chatgpt.powSolver import solve_range
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36"
+SCRIPT = "https://cdn.oaistatic.com/_next/static/cXh69klOLzS0Gy2joLDRS/_ssgManifest.js?dpl=453ebaec0d44c2decab71692e1bfe39be35a24b3"
+DPL = "prod-f501fe933b3edf57aea882da888e1a544df99840"
+
+
+def make_config(user_agent=USER_AGENT):
+    return [
+        random.choice([1920 + 1080, 2560 + 1440, 1920 + 1200, 2560 + 1600]),
+        "Mon Jan 06 2025 10:00:00 GMT-0500 (Eastern Standard Time)",
+        4294705152,
+        0,
+        user_agent,
+        SCRIPT,
+        DPL,
+        "en-US",
+        "en-US,es-US,en,es",
+        0,
+        "hardwareConcurrency−32",
+        "location",
+        "__NEXT_DATA__",
+        time.perf_counter() * 1000,
+        str(uuid.uuid4()),
+        "",
+        random.choice([8, 16, 24, 32]),
+        time.time() * 1000 - (time.perf_counter() * 1000),
+    ]
+
+
+def reference_answer(seed, diff, config, iterations=500000, step=1):
+    # the solver loop as it was before the incremental rewrite, kept as the equivalence baseline
+    diff_len = len(diff)
+    seed_encoded = seed.encode()
+    static_config_part1 = (json.dumps(config[:3], separators=(',', ':'), ensure_ascii=False)[:-1] + ',').encode()
+    static_config_part2 = (',' + json.dumps(config[4:9], separators=(',', ':'), ensure_ascii=False)[1:-1] + ',').encode()
+    static_config_part3 = (',' + json.dumps(config[10:], separators=(',', ':'), ensure_ascii=False)[1:]).encode()
+
+    target_diff = bytes.fromhex(diff)
+
+    for i in range(0, iterations, step):
+        dynamic_json_i = str(i).encode()
+        dynamic_json_j = str(i >> 1).encode()
+        final_json_bytes = static_config_part1 + dynamic_json_i + static_config_part2 + dynamic_json_j + static_config_part3
+        base_encode = pybase64.b64encode(final_json_bytes)
+        hash_value = hashlib.sha3_512(seed_encoded + base_encode).digest()
+        if hash_value[:diff_len] <= target_diff:
+            return base_encode.decode()
+    return None
+
+
+def check_equivalence(rounds=200):
+    mismatches = 0
+    for n in range(rounds):
+        user_agent = USER_AGENT[:random.randint(10, len(USER_AGENT))] + "é" * (n % 3)
+        config = make_config(user_agent)
+        seed = format(random.random())
+        diff = random.choice(["ffffff", "0fffff", "03ffff", "00ffff"])
+        if reference_answer(seed, diff, config) != solve_range(seed, diff, config):
+            mismatches += 1
+    return mismatches
+
+
+def hashes_per_second(solver, step=10, repeat=3):
+    config = make_config()
+    best = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        solver(format(random.random()), "000000", config, step=step)
+        elapsed = time.perf_counter() - start
+        best = max(best, (500000 // step) / elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    mismatches = check_equivalence()
+    print(f"equivalence: {'ok' if not mismatches else f'{mismatches} mismatches'}")
+    before = hashes_per_second(lambda seed, diff, config, step: reference_answer(seed, diff, config, step=step))
+    after = hashes_per_second(lambda seed, diff, config, step: solve_range(seed, diff, config, step=step))
+    print(f"before: {before:,.0f} hashes/s")
+    print(f"after:  {after:,.0f} hashes/s ({after / before:.2f}x)")
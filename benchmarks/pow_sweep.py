@@ -0,0 +1,155 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+import pybase64
+from starlette.concurrency import run_in_threadpool
+
+from benchmarks.pow_benchmark import USER_AGENT, make_config
+from chatgpt.powSolver import MAX_ITERATIONS, PowSolverPool
+from chatgpt.proofofWork import generate_answer
+from utils.configs import pow_difficulty
+
+DIFFICULTY_FACTORS = [4, 2, 1, 0.5, 0.25]
+
+
+def sweep_difficulties(base=pow_difficulty, factors=DIFFICULTY_FACTORS):
+    # a larger prefix value is an easier target, so factors above 1 are easier than POW_DIFFICULTY
+    width = len(base)
+    value = int(base, 16)
+    difficulties = []
+    for factor in factors:
+        diff = format(min(max(int(value * factor), 1), 16 ** width - 1), f"0{width}x")
+        if diff not in difficulties:
+            difficulties.append(diff)
+    return difficulties
+
+
+def make_user_agent(length):
+    return (USER_AGENT * (length // len(USER_AGENT) + 1))[:length]
+
+
+def tried_nonces(answer):
+    # the nonce sits at index 3 of the encoded config, every nonce below it was hashed by some worker
+    if answer is None:
+        return MAX_ITERATIONS
+    try:
+        return json.loads(pybase64.b64decode(answer))[3] + 1
+    except Exception:
+        return 0
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+async def solve_threadpool(seed, diff, config):
+    answer, solved = await run_in_threadpool(generate_answer, seed, diff, config)
+    return answer if solved else None
+
+
+def pooled_solver(pool):
+    async def solve(seed, diff, config):
+        # slots are handed back once the cancelled sibling workers exit, wait for one instead of a 503
+        while not pool.free_slots:
+            await asyncio.sleep(0.001)
+        return await pool.solve(seed, diff, config)
+
+    return solve
+
+
+def summarize(samples):
+    latencies = [sample["ms"] for sample in samples]
+    total_time = sum(latencies) / 1000
+    total_hashes = sum(sample["hashes"] for sample in samples)
+    return {
+        "samples": len(samples),
+        "success_rate": sum(sample["solved"] for sample in samples) / len(samples),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": max(latencies),
+        "hashes_per_second": total_hashes / total_time if total_time else None,
+    }
+
+
+async def run_case(solver, diff, ua_length, samples):
+    results = []
+    for _ in range(samples):
+        config = make_config(make_user_agent(ua_length))
+        seed = format(random.random())
+        start = time.perf_counter()
+        answer = await solver(seed, diff, config)
+        elapsed = (time.perf_counter() - start) * 1000
+        results.append({"ms": elapsed, "solved": answer is not None, "hashes": tried_nonces(answer)})
+    return summarize(results)
+
+
+async def run_sweep(args):
+    solvers = {}
+    pool = None
+    if "threadpool" in args.paths:
+        solvers["threadpool"] = solve_threadpool
+    if "pool" in args.paths:
+        pool = PowSolverPool(args.workers, 1)
+        pool.start()
+        solvers["pool"] = pooled_solver(pool)
+
+    cases = []
+    try:
+        for name, solver in solvers.items():
+            # warm up worker processes and imports outside the measured samples
+            await solver(format(random.random()), "ffffff", make_config())
+            for diff in args.difficulties:
+                for ua_length in args.ua_lengths:
+                    result = await run_case(solver, diff, ua_length, args.samples)
+                    result.update({"path": name, "difficulty": diff, "ua_length": ua_length})
+                    cases.append(result)
+                    print(f"{name:10} diff={diff} ua={ua_length:<4} p50={result['p50_ms']:.1f}ms "
+                          f"p99={result['p99_ms']:.1f}ms success={result['success_rate']:.2f}", file=sys.stderr)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return {
+        "pow_difficulty": pow_difficulty,
+        "max_iterations": MAX_ITERATIONS,
+        "workers": args.workers,
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "timestamp": int(time.time()),
+        "cases": cases,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep proof of work difficulty and report solve latency")
+    parser.add_argument("--difficulties", nargs="+", default=sweep_difficulties())
+    parser.add_argument("--ua-lengths", nargs="+", type=int, default=[60, 120, 400])
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--paths", nargs="+", choices=["threadpool", "pool"], default=["threadpool", "pool"])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--seed", type=int, default=None, help="random seed for reproducible configs and challenges")
+    parser.add_argument("--output", default="-", help="JSON output file, '-' for stdout")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    report = asyncio.run(run_sweep(args))
+    if args.output == "-":
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,79 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from utils.cache import LRUCache
+from utils.persist import create_store
+
+ENTRIES = 5000
+MAX_SIZE = 500
+
+
+def open_store(backend, folder, journal):
+    store = create_store(backend, os.path.join(folder, "state.db"), os.path.join(folder, "spill.db"))
+    data = LRUCache(MAX_SIZE)
+    path = os.path.join(folder, "map.json")
+    store.register("map", path, lambda: data, journal=journal, loader=lambda: load(path))
+    return store, data
+
+
+def load(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+async def fill(store, data):
+    store.start()
+    start = time.perf_counter()
+    for i in range(ENTRIES):
+        data[f"key-{i}"] = {"value": i}
+        store.mark_changed("map", f"key-{i}")
+        if i % 1000 == 0:
+            # a lookup while entries are spilled but not flushed yet
+            assert data[f"key-{i // 2}"] == {"value": i // 2}
+            await asyncio.sleep(0)
+    recent = list(data)[-10:]
+    await store.flush()
+    # flushing reads the map without moving its entries around
+    assert list(data)[-10:] == recent
+    for i in range(0, ENTRIES, 7):
+        data.pop(f"key-{i}")
+        store.mark_changed("map", f"key-{i}")
+    await store.stop()
+    return time.perf_counter() - start
+
+
+def check(backend, journal):
+    with tempfile.TemporaryDirectory() as folder:
+        store, data = open_store(backend, folder, journal)
+        elapsed = asyncio.run(fill(store, data))
+        assert len(data) <= MAX_SIZE
+
+        # a fresh process sees every entry that was not deleted, whether it was resident or spilled
+        store, data = open_store(backend, folder, journal)
+        store.flush_sync()
+        start = time.perf_counter()
+        for i in range(ENTRIES):
+            expected = None if i % 7 == 0 else {"value": i}
+            assert data.get(f"key-{i}") == expected, (backend, journal, i)
+        lookups = time.perf_counter() - start
+        assert len(data) <= MAX_SIZE
+        stats = data.stats()
+
+        data.clear()
+        store.mark_dirty("map")
+        assert "key-1" not in data
+        store, data = open_store(backend, folder, journal)
+        assert "key-1" not in data and not data
+        print(f"{backend:6} journal={journal!s:5}  {ENTRIES} writes + flush: {elapsed * 1000:7.1f}ms  "
+              f"{ENTRIES} lookups: {lookups * 1000:6.1f}ms  ok ({stats['loads']} read back from disk)")
+
+
+if __name__ == "__main__":
+    for backend in ("json", "sqlite"):
+        for journal in (False, True):
+            check(backend, journal)
@@ -0,0 +1,118 @@
+import contextlib
+import io
+import json
+import random
+import time
+import timeit
+
+import pybase64
+
+from benchmarks import turnstile_reference
+from chatgpt import turnstile
+
+SAMPLE_P = "gAAAAACWzMwMzIsIlRodSBKdWwgMTEgMjAyNCAwMzoxMDo0NiBHTVQrMDgwMCAo5Lit5Zu95qCH5YeG5pe26Ze0KSIsNDI5NDcwNTE1MiwxLCJNb3ppbGxhLzUuMCAoV2luZG93cyBOVCAxMC4wOyBXaW42NDsgeDY0KSBBcHBsZVdlYktpdC81MzcuMzYgKEtIVE1MLCBsaWtlIEdlY2tvKSBDaHJvbWUvMTI2LjAuMC4wIFNhZmFyaS81MzcuMzYgRWRnLzEyNi4wLjAuMCIsImh0dHBzOi8vY2RuLm9haXN0YXRpYy5jb20vX25leHQvc3RhdGljL2NodW5rcy9wYWdlcy9fYXBwLWMwOWZmNWY0MjQwMjcwZjguanMiLCJjL1pGWGkxeTNpMnpaS0EzSVQwNzRzMy9fIiwiemgtQ04iLCJ6aC1DTixlbixlbi1HQixlbi1VUyIsMTM1LCJ3ZWJraXRUZW1wb3JhcnlTdG9yYWdl4oiSW29iamVjdCBEZXByZWNhdGVkU3RvcmFnZVF1b3RhXSIsIl9yZWFjdExpc3RlbmluZ3NxZjF0ejFzNmsiLCJmZXRjaCIsMzY1NCwiNWU1NDUzNzItMzcyNy00ZDAyLTkwMDYtMzMwMDRjMWJmYTQ2Il0="
+
+NAMES = ["Reflect", "set", "Object", "create", "keys", "Math", "random", "performance", "now", "document",
+         "location", "localStorage", "navigator", "userAgent", "héllo"]
+HANDLERS = [1, 2, 3, 5, 6, 7, 8, 14, 15, 17, 18, 19, 20, 21, 23, 24]
+
+
+def encode_program(token_list, p):
+    dx = turnstile_reference.process_turnstile_token(json.dumps(token_list), p)
+    return pybase64.b64encode(dx.encode()).decode()
+
+
+def make_program(rng, length=64):
+    # random straight-line programs over the real instruction set, with handlers copied into
+    # float registers and called from there as the dx programs do; aliases and data live in
+    # separate registers because a stringified handler embeds a memory address
+    registers = rng.sample(range(1100, 9900), 24 + len(HANDLERS))
+    regs = [r / 100 for r in registers[:24]]
+    aliases = {handler: r / 100 for handler, r in zip(HANDLERS, registers[24:])}
+    tokens = [[8, alias, handler] for handler, alias in aliases.items()]
+    for reg in regs:
+        tokens.append([aliases[2], reg, rng.choice(NAMES + [rng.random(), None, 1000])])
+
+    def op(handler):
+        return aliases[handler] if rng.random() < 0.7 else handler
+
+    for _ in range(length):
+        e, t, n = rng.choice(regs), rng.choice(regs), rng.choice(regs)
+        kind = rng.choice(["set", "add", "xor", "prop", "copy", "b64", "json", "call", "branch", "window"])
+        if kind == "set":
+            tokens.append([op(2), e, rng.choice(NAMES + [rng.random(), None, [], "W10="])])
+        elif kind == "add":
+            tokens.append([op(5), e, t])
+        elif kind == "xor":
+            tokens.append([op(1), e, rng.choice([t, 16])])
+        elif kind == "prop":
+            tokens.append([op(rng.choice([6, 24])), e, rng.choice([t, 10]), n])
+        elif kind == "copy":
+            tokens.append([op(8), e, t])
+        elif kind == "b64":
+            tokens.append([op(19), e])
+            if rng.random() < 0.5:
+                tokens.append([op(18), e])
+        elif kind == "json":
+            tokens.append([op(rng.choice([14, 15])), e, t])
+        elif kind == "call":
+            tokens.append([op(rng.choice([7, 17])), e, t, n])
+        elif kind == "branch":
+            tokens.append([op(rng.choice([20, 23])), e, t, aliases[rng.choice([5, 19, 21])], n])
+        else:
+            tokens.append([op(24), e, 10, t])
+            tokens.append([op(17), n, e, t])
+    tokens.append([op(7), 3, rng.choice(regs)])
+    tokens.append("not an instruction")
+    tokens.append([])
+    return tokens
+
+
+def make_corpus(size=500, seed=0):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        p = rng.choice([SAMPLE_P, SAMPLE_P[:rng.randint(1, 60)], "gAAAAACé" + SAMPLE_P[8:40]])
+        corpus.append((encode_program(make_program(rng), p), p))
+    return corpus
+
+
+def run_frozen(engine, dx, p):
+    # performance.now and Math.random are the only inputs besides dx and p
+    real_time, real_time_ns = time.time, time.time_ns
+    time.time, time.time_ns = (lambda: 1700000000.0), (lambda: 1700000000123456789)
+    random.seed(1)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return engine(dx, p)
+    finally:
+        time.time, time.time_ns = real_time, real_time_ns
+
+
+def check_conformance(corpus):
+    mismatches = 0
+    outputs = 0
+    for dx, p in corpus:
+        expected = run_frozen(turnstile_reference.process_turnstile, dx, p)
+        if run_frozen(turnstile.process_turnstile, dx, p) != expected:
+            mismatches += 1
+        outputs += bool(expected)
+    return mismatches, outputs
+
+
+def per_call_ms(engine, corpus, number=3):
+    with contextlib.redirect_stdout(io.StringIO()):
+        elapsed = timeit.timeit(lambda: [engine(dx, p) for dx, p in corpus], number=number)
+    return elapsed / (number * len(corpus)) * 1000
+
+
+if __name__ == "__main__":
+    corpus = make_corpus()
+    mismatches, outputs = check_conformance(corpus)
+    print(f"conformance: {'ok' if not mismatches else f'{mismatches} mismatches'} "
+          f"({len(corpus)} programs, {outputs} with a token)")
+    large = [(encode_program(make_program(random.Random(n), length=600), SAMPLE_P), SAMPLE_P) for n in range(20)]
+    for name, programs in [("corpus", corpus), ("large", large)]:
+        before = per_call_ms(turnstile_reference.process_turnstile, programs)
+        after = per_call_ms(turnstile.process_turnstile, programs)
+        print(f"{name:7} before: {before:.3f}ms  after: {after:.3f}ms ({before / after:.1f}x)")
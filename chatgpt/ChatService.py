@@ -2,18 +2,22 @@ import asyncio
 import hashlib
 import json
 import random
+import time
 import uuid
 
 from fastapi import HTTPException
-from starlette.concurrency import run_in_threadpool
 
 from api.files import get_image_size, get_file_extension, determine_file_use_case
 from api.models import model_proxy
 from chatgpt.authorization import get_req_token, verify_token
-from chatgpt.chatFormat import api_messages_to_chat, stream_response, format_not_stream_response, head_process_response
+from chatgpt import chatFormat_v1
+from chatgpt.chatFormat import api_messages_to_chat, stream_response, format_not_stream_response
 from chatgpt.chatLimit import check_is_limit, handle_request_limit
 from chatgpt.fp import get_fp
-from chatgpt.proofofWork import get_config, get_dpl, get_answer_token, get_requirements_token
+from chatgpt.proofofWork import get_config, get_dpl, solve_answer_token, requirements_token_pool
+from chatgpt.scheduler import token_scheduler
+from chatgpt.sentinelPrefetch import SentinelPrefetcher
+from chatgpt.turnstile import solve_turnstile_token
 
 from utils.Client import Client
 from utils.Logger import logger
@@ -28,14 +32,63 @@ from utils.configs import (
     upload_by_url,
     auth_key,
     turnstile_solver_url,
+    local_turnstile,
     oai_language,
+    challenge_timeout,
+    sentinel_prefetch,
+    sentinel_prefetch_ttl,
+    sentinel_prefetch_hot,
+    sentinel_prefetch_rate,
+    delta_encoding,
 )
 
 
+def get_req_model(origin_model):
+    if "o3-mini-high" in origin_model:
+        return "o3-mini-high"
+    elif "o3-mini-medium" in origin_model:
+        return "o3-mini-medium"
+    elif "o3-mini-low" in origin_model:
+        return "o3-mini-low"
+    elif "o3-mini" in origin_model:
+        return "o3-mini"
+    elif "o3" in origin_model:
+        return "o3"
+    elif "o1-preview" in origin_model:
+        return "o1-preview"
+    elif "o1-pro" in origin_model:
+        return "o1-pro"
+    elif "o1-mini" in origin_model:
+        return "o1-mini"
+    elif "o1" in origin_model:
+        return "o1"
+    elif "gpt-4.5o" in origin_model:
+        return "gpt-4.5o"
+    elif "gpt-4o-canmore" in origin_model:
+        return "gpt-4o-canmore"
+    elif "gpt-4o-mini" in origin_model:
+        return "gpt-4o-mini"
+    elif "gpt-4o" in origin_model:
+        return "gpt-4o"
+    elif "gpt-4-mobile" in origin_model:
+        return "gpt-4-mobile"
+    elif "gpt-4" in origin_model:
+        return "gpt-4"
+    elif "gpt-3.5" in origin_model:
+        return "text-davinci-002-render-sha"
+    elif "auto" in origin_model:
+        return "auto"
+    else:
+        return "gpt-4o"
+
+
 class ChatService:
-    def __init__(self, origin_token=None):
+    def __init__(self, origin_token=None, req_token=None, model=None):
         # self.user_agent = random.choice(user_agents_list) if user_agents_list else "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36"
-        self.req_token = get_req_token(origin_token)
+        self.req_token = req_token if req_token else get_req_token(origin_token, model=get_req_model(model) if model else None)
+        self.scheduled = bool(self.req_token)
+        if self.scheduled:
+            token_scheduler.start(self.req_token)
         self.chat_token = "gAAAAAB"
         self.s = None
         self.ss = None
@@ -100,6 +153,7 @@ class ChatService:
         self.ark0se_token = None
         self.proof_token = None
         self.turnstile_token = None
+        self.challenge_timings = {}
 
         self.chat_headers = None
         self.chat_request = None
@@ -140,142 +194,172 @@ class ChatService:
         else:
             self.gizmo_id = None
 
-        if "o3-mini-high" in self.origin_model:
-            self.req_model = "o3-mini-high"
-        elif "o3-mini-medium" in self.origin_model:
-            self.req_model = "o3-mini-medium"
-        elif "o3-mini-low" in self.origin_model:
-            self.req_model = "o3-mini-low"
-        elif "o3-mini" in self.origin_model:
-            self.req_model = "o3-mini"
-        elif "o3" in self.origin_model:
-            self.req_model = "o3"
-        elif "o1-preview" in self.origin_model:
-            self.req_model = "o1-preview"
-        elif "o1-pro" in self.origin_model:
-            self.req_model = "o1-pro"
-        elif "o1-mini" in self.origin_model:
-            self.req_model = "o1-mini"
-        elif "o1" in self.origin_model:
-            self.req_model = "o1"
-        elif "gpt-4.5o" in self.origin_model:
-            self.req_model = "gpt-4.5o"
-        elif "gpt-4o-canmore" in self.origin_model:
-            self.req_model = "gpt-4o-canmore"
-        elif "gpt-4o-mini" in self.origin_model:
-            self.req_model = "gpt-4o-mini"
-        elif "gpt-4o" in self.origin_model:
-            self.req_model = "gpt-4o"
-        elif "gpt-4-mobile" in self.origin_model:
-            self.req_model = "gpt-4-mobile"
-        elif "gpt-4" in self.origin_model:
-            self.req_model = "gpt-4"
-        elif "gpt-3.5" in self.origin_model:
-            self.req_model = "text-davinci-002-render-sha"
-        elif "auto" in self.origin_model:
-            self.req_model = "auto"
-        else:
-            self.req_model = "gpt-4o"
+        self.req_model = get_req_model(self.origin_model)
+
+    def check_persona(self):
+        if self.persona != "chatgpt-paid":
+            if self.req_model == "gpt-4" or self.req_model == "o1-preview":
+                logger.error(f"Model {self.resp_model} not support for {self.persona}")
+                raise HTTPException(
+                    status_code=404,
+                    detail={
+                        "message": f"The model `{self.origin_model}` does not exist or you do not have access to it.",
+                        "type": "invalid_request_error",
+                        "param": None,
+                        "code": "model_not_found",
+                    },
+                )
 
     async def get_chat_requirements(self):
         if conversation_only:
             return None
-        url = f'{self.base_url}/sentinel/chat-requirements'
-        headers = self.base_headers.copy()
         try:
-            config = get_config(self.user_agent, self.req_token)
-            p = get_requirements_token(config)
-            data = {'p': p}
-            r = await self.ss.post(url, headers=headers, json=data, timeout=5)
-            if r.status_code == 200:
-                resp = r.json()
-
-                self.persona = resp.get("persona")
-                if self.persona != "chatgpt-paid":
-                    if self.req_model == "gpt-4" or self.req_model == "o1-preview":
-                        logger.error(f"Model {self.resp_model} not support for {self.persona}")
-                        raise HTTPException(
-                            status_code=404,
-                            detail={
-                                "message": f"The model `{self.origin_model}` does not exist or you do not have access to it.",
-                                "type": "invalid_request_error",
-                                "param": None,
-                                "code": "model_not_found",
-                            },
-                        )
-
-                turnstile = resp.get('turnstile', {})
-                turnstile_required = turnstile.get('required')
-                if turnstile_required:
-                    turnstile_dx = turnstile.get("dx")
-                    try:
-                        if turnstile_solver_url:
-                            res = await self.s.post(
-                                turnstile_solver_url, json={"url": "https://chatgpt.com", "p": p, "dx": turnstile_dx, "ua": self.user_agent}
-                            )
-                            self.turnstile_token = res.json().get("t")
-                    except Exception as e:
-                        logger.info(f"Turnstile ignored: {e}")
-                    # raise HTTPException(status_code=403, detail="Turnstile required")
-
-                ark0se = resp.get('ark' + 'ose', {})
-                ark0se_required = ark0se.get('required')
-                if ark0se_required:
-                    if self.persona == "chatgpt-freeaccount":
-                        ark0se_method = "chat35"
-                    else:
-                        ark0se_method = "chat4"
-                    if not self.ark0se_token_url:
-                        raise HTTPException(status_code=403, detail="Ark0se service required")
-                    ark0se_dx = ark0se.get("dx")
-                    ark0se_client = Client(impersonate=self.impersonate)
-                    try:
-                        r2 = await ark0se_client.post(
-                            url=self.ark0se_token_url, json={"blob": ark0se_dx, "method": ark0se_method}, timeout=15
-                        )
-                        r2esp = r2.json()
-                        logger.info(f"ark0se_token: {r2esp}")
-                        if r2esp.get('solved', True):
-                            self.ark0se_token = r2esp.get('token')
-                        else:
-                            raise HTTPException(status_code=403, detail="Failed to get Ark0se token")
-                    except Exception:
-                        raise HTTPException(status_code=403, detail="Failed to get Ark0se token")
-                    finally:
-                        await ark0se_client.close()
-
-                proofofwork = resp.get('proofofwork', {})
-                proofofwork_required = proofofwork.get('required')
-                if proofofwork_required:
-                    proofofwork_diff = proofofwork.get("difficulty")
-                    if proofofwork_diff <= pow_difficulty:
-                        raise HTTPException(status_code=403, detail=f"Proof of work difficulty too high: {proofofwork_diff}")
-                    proofofwork_seed = proofofwork.get("seed")
-                    self.proof_token, solved = await run_in_threadpool(
-                        get_answer_token, proofofwork_seed, proofofwork_diff, config
-                    )
-                    if not solved:
-                        raise HTTPException(status_code=403, detail="Failed to solve proof of work")
-
-                self.chat_token = resp.get('token')
-                if not self.chat_token:
-                    raise HTTPException(status_code=403, detail=f"Failed to get chat token: {r.text}")
-                return self.chat_token
+            bundle = sentinel_prefetcher.take(self.req_token) if sentinel_prefetch and self.req_token else None
+            if bundle:
+                logger.info("Use prefetched sentinel tokens")
+                self.persona = bundle["persona"]
+                self.check_persona()
+                self.chat_token = bundle["chat_token"]
+                self.proof_token = bundle["proof_token"]
+                self.turnstile_token = bundle["turnstile_token"]
+                self.ark0se_token = bundle["ark0se_token"]
             else:
-                if "application/json" == r.headers.get("Content-Type", ""):
-                    detail = r.json().get("detail", r.json())
-                else:
-                    detail = r.text
-                if "cf_chl_opt" in detail:
-                    raise HTTPException(status_code=r.status_code, detail="cf_chl_opt")
-                if r.status_code == 429:
-                    raise HTTPException(status_code=r.status_code, detail="rate-limit")
-                raise HTTPException(status_code=r.status_code, detail=detail)
+                await self.fetch_chat_requirements()
+            if self.req_token:
+                token_scheduler.set_persona(self.req_token, self.persona)
+            if sentinel_prefetch and self.req_token:
+                sentinel_prefetcher.watch(self.req_token, {"model": self.origin_model}, consumed=bool(bundle))
+            return self.chat_token
         except HTTPException as e:
             raise HTTPException(status_code=e.status_code, detail=e.detail)
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
 
+    async def fetch_chat_requirements(self):
+        url = f'{self.base_url}/sentinel/chat-requirements'
+        headers = self.base_headers.copy()
+        config = get_config(self.user_agent, self.req_token)
+        p = requirements_token_pool.get(config)
+        data = {'p': p}
+        r = await self.ss.post(url, headers=headers, json=data, timeout=5)
+        if r.status_code == 200:
+            resp = r.json()
+
+            self.persona = resp.get("persona")
+            self.check_persona()
+
+            turnstile = resp.get('turnstile', {})
+            turnstile_required = turnstile.get('required')
+            # raise HTTPException(status_code=403, detail="Turnstile required")
+
+            ark0se = resp.get('ark' + 'ose', {})
+            ark0se_required = ark0se.get('required')
+            if ark0se_required and not self.ark0se_token_url:
+                raise HTTPException(status_code=403, detail="Ark0se service required")
+
+            proofofwork = resp.get('proofofwork', {})
+            proofofwork_required = proofofwork.get('required')
+            proofofwork_diff = proofofwork.get("difficulty")
+            if proofofwork_required and proofofwork_diff <= pow_difficulty:
+                raise HTTPException(status_code=403, detail=f"Proof of work difficulty too high: {proofofwork_diff}")
+
+            # the solvers are only created once every precheck passed, so none is left unawaited
+            challenges = {}
+            if turnstile_required and (local_turnstile or turnstile_solver_url):
+                challenges["turnstile"] = self.solve_turnstile(p, turnstile.get("dx"))
+            if ark0se_required:
+                challenges["ark0se"] = self.solve_ark0se(ark0se.get("dx"))
+            if proofofwork_required:
+                challenges["pow"] = self.solve_pow(proofofwork.get("seed"), proofofwork_diff, config)
+
+            await self.solve_challenges(challenges)
+
+            self.chat_token = resp.get('token')
+            if not self.chat_token:
+                raise HTTPException(status_code=403, detail=f"Failed to get chat token: {r.text}")
+            return {
+                "persona": self.persona,
+                "chat_token": self.chat_token,
+                "proof_token": self.proof_token,
+                "turnstile_token": self.turnstile_token,
+                "ark0se_token": self.ark0se_token,
+            }
+        else:
+            if "application/json" == r.headers.get("Content-Type", ""):
+                detail = r.json().get("detail", r.json())
+            else:
+                detail = r.text
+            if "cf_chl_opt" in detail:
+                raise HTTPException(status_code=r.status_code, detail="cf_chl_opt")
+            if r.status_code == 429:
+                raise HTTPException(status_code=r.status_code, detail="rate-limit")
+            raise HTTPException(status_code=r.status_code, detail=detail)
+
+    async def solve_challenges(self, challenges):
+        if not challenges:
+            return
+        tasks = {name: asyncio.ensure_future(self.timed_challenge(name, coro)) for name, coro in challenges.items()}
+        try:
+            done, pending = await asyncio.wait(tasks.values(), timeout=challenge_timeout,
+                                               return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+            # turnstile is best effort, the request goes on without it
+            timed_out = [name for name, task in tasks.items() if task in pending and name != "turnstile"]
+            if timed_out:
+                raise HTTPException(status_code=403, detail=f"Challenge timed out: {', '.join(timed_out)}")
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            logger.info(f"Challenge timings: {self.challenge_timings}")
+
+    async def timed_challenge(self, name, coro):
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.challenge_timings[name] = int((time.perf_counter() - start) * 1000)
+
+    async def solve_turnstile(self, p, turnstile_dx):
+        try:
+            if local_turnstile:
+                self.turnstile_token = await solve_turnstile_token(turnstile_dx, p)
+                return
+            res = await self.s.post(
+                turnstile_solver_url, json={"url": "https://chatgpt.com", "p": p, "dx": turnstile_dx, "ua": self.user_agent}
+            )
+            self.turnstile_token = res.json().get("t")
+        except Exception as e:
+            logger.info(f"Turnstile ignored: {e}")
+
+    async def solve_ark0se(self, ark0se_dx):
+        if self.persona == "chatgpt-freeaccount":
+            ark0se_method = "chat35"
+        else:
+            ark0se_method = "chat4"
+        ark0se_client = Client(impersonate=self.impersonate)
+        try:
+            r2 = await ark0se_client.post(
+                url=self.ark0se_token_url, json={"blob": ark0se_dx, "method": ark0se_method}, timeout=15
+            )
+            r2esp = r2.json()
+            logger.info(f"ark0se_token: {r2esp}")
+            if r2esp.get('solved', True):
+                self.ark0se_token = r2esp.get('token')
+            else:
+                raise HTTPException(status_code=403, detail="Failed to get Ark0se token")
+        except Exception:
+            raise HTTPException(status_code=403, detail="Failed to get Ark0se token")
+        finally:
+            await ark0se_client.close()
+
+    async def solve_pow(self, proofofwork_seed, proofofwork_diff, config):
+        self.proof_token, solved = await solve_answer_token(
+            proofofwork_seed, proofofwork_diff, config
+        )
+        if not solved:
+            raise HTTPException(status_code=403, detail="Failed to solve proof of work")
+
     async def prepare_send_conversation(self):
         try:
             chat_messages, self.prompt_tokens = await api_messages_to_chat(self, self.api_messages, upload_by_url)
@@ -334,7 +418,7 @@ class ChatService:
             "parent_message_id": self.parent_message_id if self.parent_message_id else f"{uuid.uuid4()}",
             "reset_rate_limits": False,
             "suggestions": [],
-            "supported_encodings": [],
+            "supported_encodings": ["v1"] if delta_encoding else [],
             "system_hints": [],
             "timezone": "America/Los_Angeles",
             "timezone_offset_min": -480,
@@ -369,17 +453,19 @@ class ChatService:
 
             content_type = r.headers.get("Content-Type", "")
             if "text/event-stream" in content_type:
-                res, start = await head_process_response(r.aiter_lines())
+                res, start, delta = await chatFormat_v1.head_process_response(r.aiter_lines())
                 if not start:
                     raise HTTPException(
                         status_code=403,
                         detail="Our systems have detected unusual activity coming from your system. Please try again later.",
                     )
+                # upstream may still answer with full cumulative messages, translate whichever it sent
+                translate = chatFormat_v1.stream_response if delta else stream_response
                 if stream:
-                    return stream_response(self, res, self.resp_model, self.max_tokens)
+                    return translate(self, res, self.resp_model, self.max_tokens)
                 else:
                     return await format_not_stream_response(
-                        stream_response(self, res, self.resp_model, self.max_tokens),
+                        translate(self, res, self.resp_model, self.max_tokens),
                         self.prompt_tokens,
                         self.max_tokens,
                         self.resp_model,
@@ -547,6 +633,9 @@ class ChatService:
             return None
 
     async def close_client(self):
+        if self.scheduled:
+            self.scheduled = False
+            token_scheduler.finish(self.req_token)
         if self.s:
             await self.s.close()
             del self.s
@@ -556,3 +645,16 @@ class ChatService:
         if self.ws:
             await self.ws.close()
             del self.ws
+
+
+async def prefetch_chat_requirements(req_token, data):
+    chat_service = ChatService(req_token=req_token)
+    try:
+        await chat_service.set_dynamic_data(data)
+        return await chat_service.fetch_chat_requirements()
+    finally:
+        await chat_service.close_client()
+
+
+sentinel_prefetcher = SentinelPrefetcher(prefetch_chat_requirements, sentinel_prefetch_ttl, sentinel_prefetch_hot,
+                                         sentinel_prefetch_rate)
@@ -1,37 +1,29 @@
 import asyncio
 import json
-import random
+import time
 
 from fastapi import HTTPException
 
 import utils.configs as configs
 import utils.globals as globals
-from chatgpt.refreshToken import rt2ac
+from chatgpt.scheduler import token_scheduler
+from chatgpt.refreshToken import rt2ac, get_token_exp, add_error_token
 from utils.Logger import logger
 
 
-def get_req_token(req_token, seed=None):
+def get_req_token(req_token, seed=None, model=None):
     if configs.auto_seed:
-        available_token_list = list(set(globals.token_list) - set(globals.error_token_list))
-        length = len(available_token_list)
-        if seed and length > 0:
+        if seed and len(globals.token_registry) > 0:
             if seed not in globals.seed_map.keys():
-                globals.seed_map[seed] = {"token": random.choice(available_token_list), "conversations": []}
-                with open(globals.SEED_MAP_FILE, "w") as f:
-                    json.dump(globals.seed_map, f, indent=4)
+                globals.seed_map[seed] = {"token": token_scheduler.select(), "conversations": []}
+                globals.map_store.mark_changed("seed_map", seed)
             else:
                 req_token = globals.seed_map[seed]["token"]
             return req_token
 
         if req_token in configs.authorization_list:
-            if len(available_token_list) > 0:
-                if configs.random_token:
-                    req_token = random.choice(available_token_list)
-                    return req_token
-                else:
-                    globals.count += 1
-                    globals.count %= length
-                    return available_token_list[globals.count]
+            if len(globals.token_registry) > 0:
+                return token_scheduler.select(model)
             else:
                 return ""
         else:
@@ -56,7 +48,7 @@ async def verify_token(req_token):
             return access_token
         elif len(req_token) == 45:
             try:
-                if req_token in globals.error_token_list:
+                if globals.token_registry.is_error(req_token):
                     raise HTTPException(status_code=401, detail="Error RefreshToken")
 
                 access_token = await rt2ac(req_token, force_refresh=False)
@@ -67,12 +59,78 @@ async def verify_token(req_token):
             return req_token
 
 
-async def refresh_all_tokens(force_refresh=False):
-    for token in list(set(globals.token_list) - set(globals.error_token_list)):
-        if len(token) == 45:
+class RefreshJob:
+    def __init__(self, tokens, force_refresh=False, concurrency=configs.refresh_concurrency):
+        self.tokens = list(dict.fromkeys(tokens))
+        self.force_refresh = force_refresh
+        self.semaphore = asyncio.Semaphore(max(concurrency, 1))
+        self.done = 0
+        self.ok = 0
+        self.failed = []
+        self.started = time.time()
+        self.finished = None
+        self.changed = asyncio.Event()
+        self.task = None
+
+    def progress(self):
+        return {
+            "total": len(self.tokens),
+            "done": self.done,
+            "ok": self.ok,
+            "failed": len(self.failed),
+            "elapsed": round((self.finished or time.time()) - self.started, 1),
+            "finished": self.finished is not None,
+        }
+
+    async def run(self):
+        try:
+            await asyncio.gather(*[self.check(token) for token in self.tokens])
+        finally:
+            self.finished = time.time()
+            self.changed.set()
+        logger.info(f"Refresh job finished: {self.progress()}")
+        return self.progress()
+
+    async def check(self, token):
+        async with self.semaphore:
             try:
-                await asyncio.sleep(0.5)
-                await rt2ac(token, force_refresh=force_refresh)
+                if len(token) == 45:
+                    await rt2ac(token, force_refresh=self.force_refresh)
+                elif token.startswith("eyJhbGciOi"):
+                    exp = get_token_exp(token)
+                    if exp and exp < time.time():
+                        add_error_token(token)
+                        raise HTTPException(status_code=401, detail="AccessToken expired")
+                self.ok += 1
             except HTTPException:
+                self.failed.append(token)
+            finally:
+                self.done += 1
+                self.changed.set()
+
+    async def stream(self, interval=0.5):
+        while True:
+            self.changed.clear()
+            yield json.dumps(self.progress()) + "\n"
+            if self.finished is not None:
+                break
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout=5)
+            except asyncio.TimeoutError:
                 pass
-    logger.info("All tokens refreshed.")
+            await asyncio.sleep(interval)
+
+
+refresh_job = None
+
+
+def start_refresh_job(tokens, force_refresh=False):
+    global refresh_job
+    if refresh_job is None or refresh_job.finished is not None:
+        refresh_job = RefreshJob(tokens, force_refresh)
+        refresh_job.task = asyncio.get_running_loop().create_task(refresh_job.run())
+    return refresh_job
+
+
+def get_refresh_job():
+    return refresh_job
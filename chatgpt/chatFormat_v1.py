@@ -1,97 +1,144 @@
-import asyncio
 import json
 import random
 import re
 import string
 import time
-import uuid
 
-import pybase64
-import websockets
-from fastapi import HTTPException
-
-from api.files import get_file_content
 from api.models import model_system_fingerprint
-from api.tokens import split_tokens_from_content, calculate_image_tokens, num_tokens_from_messages
+from chatgpt.chatFormat import moderation_message
 from utils.Logger import logger
 
-moderation_message = "I'm sorry, I cannot provide or engage in any content related to pornography, violence, or any unethical material. If you have any other questions or need assistance, please feel free to let me know. I'll do my best to provide support and assistance."
+TEXT_PATHS = ("/message/content/parts/0", "/message/content/text")
 
 
-async def format_not_stream_response(response, prompt_tokens, max_tokens, model):
-    chat_id = f"chatcmpl-{''.join(random.choice(string.ascii_letters + string.digits) for _ in range(29))}"
-    system_fingerprint_list = model_system_fingerprint.get(model, None)
-    system_fingerprint = random.choice(system_fingerprint_list) if system_fingerprint_list else None
-    created_time = int(time.time())
-    all_text = ""
-    async for chunk in response:
-        try:
-            if chunk.startswith("data: [DONE]"):
-                break
-            elif not chunk.startswith("data: "):
-                continue
+class TextChunks(list):
+    # a string built up by appends, joined only when read so a long answer is never copied per delta
+    def __str__(self):
+        return "".join(self)
+
+
+class DeltaDecoder:
+    # rebuilds the streamed message from v1 delta events: {"p": path, "o": op, "v": value},
+    # where a missing p or o repeats the previous one and "patch" carries a list of them
+    def __init__(self):
+        self.root = {}
+        self.path = ""
+        self.op = "add"
+
+    def feed(self, data):
+        path = data.get("p", self.path)
+        op = data.get("o", self.op)
+        value = data.get("v")
+        if op == "patch":
+            ops = []
+            for item in value:
+                ops.extend(self.feed(item))
+            return ops
+        self.path, self.op = path, op
+        self.apply(path, op, value)
+        return [(path, op, value)]
+
+    def apply(self, path, op, value):
+        if not path:
+            if op in ("add", "replace"):
+                self.root = value
+            return
+        *parents, key = path[1:].split("/")
+        target = self.root
+        for name in parents:
+            target = target[int(name)] if isinstance(target, list) else target.setdefault(name, {})
+        if isinstance(target, list):
+            key = int(key)
+            if key == len(target):
+                target.append(None)
+        current = target[key] if isinstance(target, list) else target.get(key)
+        if op in ("add", "replace") or current is None and op == "append":
+            target[key] = value
+        elif op == "append":
+            if isinstance(current, TextChunks):
+                current.append(value)
+            elif isinstance(current, str):
+                target[key] = TextChunks([current, value])
+            elif isinstance(current, list):
+                current.extend(value if isinstance(value, list) else [value])
+            elif isinstance(current, dict):
+                current.update(value)
+        elif op == "truncate":
+            target[key] = str(current)[:value] if isinstance(current, (str, TextChunks)) else current[:value]
+        elif op == "remove":
+            del target[key]
+
+    def get(self, path):
+        value = self.root
+        for name in path[1:].split("/"):
+            if isinstance(value, list):
+                value = value[int(name)] if int(name) < len(value) else None
+            elif isinstance(value, dict):
+                value = value.get(name)
             else:
-                chunk = json.loads(chunk[6:])
-                if not chunk["choices"][0].get("delta"):
-                    continue
-                all_text += chunk["choices"][0]["delta"]["content"]
-        except Exception as e:
-            logger.error(f"Error: {chunk}, error: {str(e)}")
-            continue
-    content, completion_tokens, finish_reason = await split_tokens_from_content(all_text, max_tokens, model)
-    message = {
-        "role": "assistant",
-        "content": content,
-    }
-    usage = {
-        "prompt_tokens": prompt_tokens,
-        "completion_tokens": completion_tokens,
-        "total_tokens": prompt_tokens + completion_tokens
-    }
-    if not message.get("content"):
-        raise HTTPException(status_code=403, detail="No content in the message.")
+                return None
+        return value
 
-    data = {
-        "id": chat_id,
-        "object": "chat.completion",
-        "created": created_time,
-        "model": model,
-        "choices": [
-            {
-                "index": 0,
-                "message": message,
-                "logprobs": None,
-                "finish_reason": finish_reason
-            }
-        ],
-        "usage": usage
-    }
-    if system_fingerprint:
-        data["system_fingerprint"] = system_fingerprint
-    return data
+    def text(self, path):
+        value = self.get(path)
+        return str(value) if isinstance(value, (str, TextChunks)) else ""
 
 
-async def head_process_response(response):
+def is_delta(data):
+    return isinstance(data, dict) and "v" in data
+
+
+async def replay(consumed, response):
+    for chunk in consumed:
+        yield chunk
     async for chunk in response:
-        chunk = chunk.decode("utf-8")
-        if chunk.startswith("data: {"):
-            chunk_old_data = json.loads(chunk[6:])
-            message = chunk_old_data.get("message", {})
-            if not message and "error" in chunk_old_data:
-                return response, False
-            role = message.get('author', {}).get('role')
-            if role == 'user' or role == 'system':
-                continue
+        yield chunk
 
-            status = message.get("status")
-            if status == "in_progress":
-                return response, True
-    return response, False
+
+async def head_process_response(response):
+    # like chatFormat.head_process_response, but the lines it reads are handed back, since
+    # dropping the first delta event would lose the message every later patch applies to
+    consumed = []
+    decoder = DeltaDecoder()
+    delta = False
+    async for chunk in response:
+        consumed.append(chunk)
+        line = chunk.decode("utf-8")
+        if line.startswith("event: delta"):
+            delta = True
+        if not line.startswith("data: {"):
+            continue
+        data = json.loads(line[6:])
+        if is_delta(data):
+            delta = True
+            decoder.feed(data)
+            message = decoder.root.get("message", {}) if isinstance(decoder.root, dict) else {}
+        else:
+            message = data.get("message", {})
+            if not message and "error" in data:
+                return replay(consumed, response), False, delta
+        role = message.get('author', {}).get('role')
+        if role == 'user' or role == 'system':
+            continue
+        if message.get("status") == "in_progress":
+            return replay(consumed, response), True, delta
+    return replay(consumed, response), False, delta
 
 
 async def stream_response(service, response, model, max_tokens):
     chat_id = f"chatcmpl-{''.join(random.choice(string.ascii_letters + string.digits) for _ in range(29))}"
+    system_fingerprint_list = model_system_fingerprint.get(model, None)
+    system_fingerprint = random.choice(system_fingerprint_list) if system_fingerprint_list else None
     created_time = int(time.time())
+    completion_tokens = 0
+    len_text = 0
+    len_last_citation = 0
+    last_role = None
+    last_content_type = None
+    model_slug = None
+    conversation_id = None
+    decoder = DeltaDecoder()
+    end = False
 
     chunk_new_data = {
         "id": chat_id,
@@ -107,128 +154,193 @@ async def stream_response(service, response, model, max_tokens):
             }
         ]
     }
+    if system_fingerprint:
+        chunk_new_data["system_fingerprint"] = system_fingerprint
     yield f"data: {json.dumps(chunk_new_data)}\n\n"
 
     async for chunk in response:
         chunk = chunk.decode("utf-8")
+        if end:
+            logger.info(f"Response Model: {model_slug}")
+            yield "data: [DONE]\n\n"
+            break
         try:
             if chunk.startswith("data: {"):
-                chunk_old_data = json.loads(chunk[6:].strip())
-        except Exception as e:
-            logger.error(f"Error: {chunk}, error: {str(e)}")
-            continue
+                data = json.loads(chunk[6:])
+                finish_reason = None
+                if not is_delta(data):
+                    if data.get("error"):
+                        logger.error(f"Error: {data.get('error')}")
+                        yield "data: [DONE]\n\n"
+                        break
+                    if data.get("type") != "moderation":
+                        continue
+                    delta = {"role": "assistant", "content": moderation_message}
+                    finish_reason = "stop"
+                    end = True
+                    message_id = None
+                else:
+                    ops = decoder.feed(data)
+                    if not isinstance(decoder.root, dict):
+                        continue
+                    conversation_id = decoder.root.get("conversation_id", conversation_id)
+                    message = decoder.root.get("message", {})
+                    role = message.get('author', {}).get('role')
+                    if role == 'user' or role == 'system':
+                        continue
 
+                    status = message.get("status")
+                    message_id = message.get("id")
+                    content = message.get("content", {})
+                    outer_content_type = content.get("content_type")
+                    recipient = message.get("recipient", "")
+                    meta_data = message.get("metadata", {})
+                    initial_text = meta_data.get("initial_text", "")
+                    model_slug = meta_data.get("model_slug", model_slug)
 
-def get_url_from_content(content):
-    if isinstance(content, str) and content.startswith('http'):
-        try:
-            url = re.match(
-                r'(?i)\b((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:\'".,<>?«»“”‘’]))',
-                content.split(' ')[0])[0]
-            content = content.replace(url, '').strip()
-            return url, content
-        except Exception:
-            return None, content
-    return None, content
-
-
-def format_messages_with_url(content):
-    url_list = []
-    while True:
-        url, content = get_url_from_content(content)
-        if url:
-            url_list.append(url)
-            logger.info(f"Found a file_url from messages: {url}")
-        else:
-            break
-    if not url_list:
-        return content
-    new_content = [
-        {
-            "type": "text",
-            "text": content
-        }
-    ]
-    for url in url_list:
-        new_content.append({
-            "type": "image_url",
-            "image_url": {
-                "url": url
-            }
-        })
-    return new_content
-
-
-async def api_messages_to_chat(service, api_messages, upload_by_url=False):
-    file_tokens = 0
-    chat_messages = []
-    for api_message in api_messages:
-        role = api_message.get('role')
-        content = api_message.get('content')
-        if upload_by_url:
-            if isinstance(content, str):
-                content = format_messages_with_url(content)
-        if isinstance(content, list):
-            parts = []
-            attachments = []
-            content_type = "multimodal_text"
-            for i in content:
-                if i.get("type") == "text":
-                    parts.append(i.get("text"))
-                elif i.get("type") == "image_url":
-                    image_url = i.get("image_url")
-                    url = image_url.get("url")
-                    detail = image_url.get("detail", "auto")
-                    file_content, mime_type = await get_file_content(url)
-                    file_meta = await service.upload_file(file_content, mime_type)
-                    if file_meta:
-                        file_id = file_meta["file_id"]
-                        file_size = file_meta["size_bytes"]
-                        file_name = file_meta["file_name"]
-                        mime_type = file_meta["mime_type"]
-                        use_case = file_meta["use_case"]
-                        if mime_type.startswith("image/"):
-                            width, height = file_meta["width"], file_meta["height"]
-                            file_tokens += await calculate_image_tokens(width, height, detail)
-                            parts.append({
-                                "content_type": "image_asset_pointer",
-                                "asset_pointer": f"file-service://{file_id}",
-                                "size_bytes": file_size,
-                                "width": width,
-                                "height": height
-                            })
-                            attachments.append({
-                                "id": file_id,
-                                "size": file_size,
-                                "name": file_name,
-                                "mime_type": mime_type,
-                                "width": width,
-                                "height": height
-                            })
+                    started = any(not path for path, _, _ in ops)
+                    if started:
+                        # a new message arrives whole, whatever text it already has is new
+                        len_text = 0
+                        text_path = TEXT_PATHS[0] if outer_content_type in ("text", "multimodal_text") else TEXT_PATHS[1]
+                        appended = decoder.text(text_path)
+                    else:
+                        appended = "".join(value for path, op, value in ops
+                                           if op == "append" and path in TEXT_PATHS and isinstance(value, str))
+                    finished = status == "finished_successfully" and (started or any(path == "/message/status" for path, _, _ in ops))
+
+                    new_text = None
+                    if status == "in_progress" or appended and not started:
+                        if outer_content_type == "text":
+                            if not len_text and not appended:
+                                if role == 'assistant' and last_role != 'assistant':
+                                    new_text = "" if last_role is None else "\n"
+                                elif role == 'tool' and last_role != 'tool':
+                                    new_text = f">{initial_text}\n"
+                                else:
+                                    new_text = ""
+                            else:
+                                new_text = ""
+                                citation = meta_data.get("citations", [])
+                                if len(citation) > len_last_citation:
+                                    inside_metadata = citation[-1].get("metadata", {})
+                                    citation_title = inside_metadata.get("title", "")
+                                    citation_url = inside_metadata.get("url", "")
+                                    new_text = f' **[[""]]({citation_url} "{citation_title}")** '
+                                    len_last_citation = len(citation)
+                                if role == 'assistant' and last_role != 'assistant':
+                                    if recipient == 'dalle.text2im':
+                                        new_text += f"\n```{recipient}\n{appended}"
+                                    elif recipient == 't2uay3k.sj1i4kz':
+                                        new_text += f"\n```image_creator\n{appended}"
+                                    elif last_role is None:
+                                        new_text += appended
+                                    else:
+                                        new_text += f"\n\n{appended}"
+                                elif role == 'tool' and last_role != 'tool':
+                                    new_text += f">{initial_text}\n{appended}"
+                                elif role == 'tool':
+                                    new_text += appended.replace("\n\n", "\n")
+                                else:
+                                    new_text += appended
+                        elif outer_content_type == "multimodal_text":
+                            new_text = ""
+                            for part in content.get("parts", []):
+                                if not isinstance(part, dict):
+                                    continue
+                                file_id = part.get('asset_pointer', '').replace('sediment://', '')
+                                full_height = part.get("height", 0)
+                                current_height = part.get('metadata', {}).get("generation", {}).get("height", 0)
+                                if full_height > current_height:
+                                    completed_rate = current_height / full_height
+                                    new_text = f"\n> {completed_rate:.2%}\n"
+                                    if last_role != role:
+                                        new_text = f"\n```{new_text}"
+                                else:
+                                    image_download_url = await service.get_attachment_url(file_id, conversation_id)
+                                    new_text = f"\n```\n![image]({image_download_url})\n"
+                        elif outer_content_type == "code" and last_content_type != "code":
+                            language = content.get("language", "")
+                            if not language or language == "unknown":
+                                language = recipient
+                            new_text = "\n```" + language + "\n" + appended
+                        elif outer_content_type == "execution_output" and last_content_type != "execution_output":
+                            new_text = "\n```" + "Output" + "\n" + appended
                         else:
-                            if not use_case == "ace_upload":
-                                await service.check_upload(file_id)
-                            file_tokens += file_size // 1000
-                            attachments.append({
-                                "id": file_id,
-                                "size": file_size,
-                                "name": file_name,
-                                "mime_type": mime_type,
-                            })
-            metadata = {
-                "attachments": attachments
-            }
-        else:
-            content_type = "text"
-            parts = [content]
-            metadata = {}
-        chat_message = {
-            "id": f"{uuid.uuid4()}",
-            "author": {"role": role},
-            "content": {"content_type": content_type, "parts": parts},
-            "metadata": metadata
-        }
-        chat_messages.append(chat_message)
-    text_tokens = await num_tokens_from_messages(api_messages, service.resp_model)
-    prompt_tokens = text_tokens + file_tokens
-    return chat_messages, prompt_tokens
+                            new_text = appended
+                        len_text += len(appended)
+                        if last_content_type in ("code", "execution_output", "multimodal_text") and outer_content_type != last_content_type:
+                            new_text = "\n```\n" + new_text
+
+                        delta = {"content": new_text}
+                        last_content_type = outer_content_type
+                        if completion_tokens >= max_tokens:
+                            delta = {}
+                            finish_reason = "length"
+                            end = True
+
+                    # the last text of a message often comes in the same patch that finishes it
+                    if finished and not end:
+                        if outer_content_type == "multimodal_text":
+                            delta = {}
+                            for part in content.get("parts", []):
+                                if not isinstance(part, dict) or part.get('content_type') != "image_asset_pointer":
+                                    continue
+                                last_content_type = "image_asset_pointer"
+                                if part.get('asset_pointer').startswith('file-service://'):
+                                    file_id = part.get('asset_pointer').replace('file-service://', '')
+                                    image_download_url = await service.get_download_url(file_id)
+                                    if image_download_url:
+                                        delta = {"content": f"\n```\n![image]({image_download_url})\n"}
+                                    else:
+                                        delta = {"content": f"\n```\nFailed to load the image.\n"}
+                                else:
+                                    file_id = part.get('asset_pointer').replace('sediment://', '')
+                                    image_download_url = await service.get_attachment_url(file_id, conversation_id)
+                                    delta = {"content": f"\n![image]({image_download_url})\n"}
+                        elif message.get("end_turn"):
+                            if new_text is None:
+                                new_text = appended
+                            if not new_text:
+                                matches = re.findall(r'\(sandbox:(.*?)\)', decoder.text(TEXT_PATHS[0]))
+                                if matches:
+                                    file_url_content = ""
+                                    for i, sandbox_path in enumerate(matches):
+                                        file_download_url = await service.get_response_file_url(conversation_id, message_id, sandbox_path)
+                                        if file_download_url:
+                                            file_url_content += f"\n```\n\n![File {i+1}]({file_download_url})\n"
+                                    delta = {"content": file_url_content}
+                                else:
+                                    delta = {}
+                            else:
+                                delta = {"content": new_text}
+                            finish_reason = "stop"
+                            end = True
+                        else:
+                            len_text = 0
+                            if meta_data.get("finished_text"):
+                                delta = {"content": f"{new_text or ''}\n{meta_data.get('finished_text')}\n"}
+                            elif new_text is None:
+                                continue
+                    elif new_text is None:
+                        continue
+                    last_role = role
+                if not end and not delta.get("content"):
+                    delta = {"role": "assistant", "content": ""}
+                chunk_new_data["choices"][0]["delta"] = delta
+                chunk_new_data["choices"][0]["finish_reason"] = finish_reason
+                if not service.history_disabled:
+                    chunk_new_data.update({
+                        "message_id": message_id,
+                        "conversation_id": conversation_id,
+                    })
+                completion_tokens += 1
+                yield f"data: {json.dumps(chunk_new_data)}\n\n"
+            elif chunk.startswith("data: [DONE]"):
+                logger.info(f"Response Model: {model_slug}")
+                yield "data: [DONE]\n\n"
+            else:
+                continue
+        except Exception as e:
+            logger.error(f"Error: {chunk}, details: {str(e)}")
+            continue
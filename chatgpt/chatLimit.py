@@ -1,33 +1,105 @@
+import asyncio
+import heapq
 import time
 from datetime import datetime
 
 from utils.Logger import logger
 
-limit_details = {}
+
+class RateLimitTable:
+    def __init__(self):
+        self.details = {}
+        self.by_model = {}
+        # min-heap of (clear_time, token, model), entries overwritten by a later limit are skipped on pop
+        self.heap = []
+        self.task = None
+
+    def set(self, token, model, clear_time):
+        self.evict()
+        self.details.setdefault(token, {})[model] = clear_time
+        self.by_model.setdefault(model, {})[token] = clear_time
+        heapq.heappush(self.heap, (clear_time, token, model))
+
+    def get(self, token, model):
+        clear_time = self.details.get(token, {}).get(model)
+        if clear_time is not None and clear_time <= time.time():
+            self.remove(token, model)
+            return None
+        return clear_time
+
+    def remove(self, token, model):
+        models = self.details.get(token)
+        if models is not None:
+            models.pop(model, None)
+            if not models:
+                del self.details[token]
+        tokens = self.by_model.get(model)
+        if tokens is not None:
+            tokens.pop(token, None)
+            if not tokens:
+                del self.by_model[model]
+
+    def is_limited(self, token, model):
+        if not model:
+            return False
+        return self.get(token, model) is not None
+
+    def evict(self, now=None):
+        now = now or time.time()
+        evicted = 0
+        while self.heap and self.heap[0][0] <= now:
+            clear_time, token, model = heapq.heappop(self.heap)
+            if self.details.get(token, {}).get(model) == clear_time:
+                self.remove(token, model)
+                evicted += 1
+        return evicted
+
+    def limited_tokens(self, model):
+        self.evict()
+        return self.by_model.get(model, {})
+
+    def usable_tokens(self, model, tokens):
+        limited = self.limited_tokens(model)
+        if not limited:
+            return list(tokens)
+        return [token for token in tokens if token not in limited]
+
+    async def evict_forever(self, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            evicted = self.evict()
+            if evicted:
+                logger.info(f"Rate limit table evicted {evicted} cleared limits, {len(self.heap)} pending")
+
+    def start(self, interval=60):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.evict_forever(interval))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+rate_limits = RateLimitTable()
+limit_details = rate_limits.details
 
 
 def check_is_limit(detail, token, model):
     if token and isinstance(detail, dict) and detail.get('clears_in'):
         clear_time = int(time.time()) + detail.get('clears_in')
-        limit_details.setdefault(token, {})[model] = clear_time
+        rate_limits.set(token, model, clear_time)
         logger.info(f"{token[:40]}: Reached {model} limit, will be cleared at {datetime.fromtimestamp(clear_time).replace(microsecond=0)}")
 
 
 async def handle_request_limit(token, model):
     try:
-        if limit_details.get(token) and model in limit_details[token]:
-            limit_time = limit_details[token][model]
-            is_limit = limit_time > int(time.time())
-            if is_limit:
-                clear_date = datetime.fromtimestamp(limit_time).replace(microsecond=0)
-                result = f"Request limit exceeded. You can continue with the default model now, or try again after {clear_date}"
-                logger.info(result)
-                return result
-            else:
-                del limit_details[token][model]
-                return None
-    except KeyError as e:
-        logger.error(f"Key error: {e}")
+        limit_time = rate_limits.get(token, model)
+        if limit_time is not None:
+            clear_date = datetime.fromtimestamp(limit_time).replace(microsecond=0)
+            result = f"Request limit exceeded. You can continue with the default model now, or try again after {clear_date}"
+            logger.info(result)
+            return result
         return None
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}")
@@ -1,6 +1,7 @@
-import json
+import asyncio
 import random
 import uuid
+from collections import deque
 
 import ua_generator
 from ua_generator.data.version import VersionRange
@@ -8,54 +9,121 @@ from ua_generator.options import Options
 
 import utils.globals as globals
 from utils import configs
+from utils.Logger import logger
+from utils.cache import LRUCache
 
+FP_OPTIONS = Options(version_ranges={
+    'chrome': VersionRange(min_version=124),
+    'edge': VersionRange(min_version=124),
+})
+FP_BATCH = 16
 
-def get_fp(req_token):
-    fp = globals.fp_map.get(req_token, {})
-    if fp and fp.get("user-agent") and fp.get("impersonate"):
+
+class FingerprintStore:
+    def __init__(self):
+        # token -> lowercased fingerprint, callers copy it before adding headers
+        self.cache = LRUCache(max_size=4096)
+
+    def reconcile(self, fp):
+        changed = False
         if "proxy_url" in fp.keys() and (fp["proxy_url"] is None or fp["proxy_url"] not in configs.proxy_url_list):
-            fp["proxy_url"] = random.choice(configs.proxy_url_list) if configs.proxy_url_list else None
-            globals.fp_map[req_token] = fp
-            with open(globals.FP_FILE, "w", encoding="utf-8") as f:
-                json.dump(globals.fp_map, f, indent=4)
+            proxy_url = random.choice(configs.proxy_url_list) if configs.proxy_url_list else None
+            changed = changed or fp["proxy_url"] != proxy_url
+            fp["proxy_url"] = proxy_url
         if globals.impersonate_list and "impersonate" in fp.keys() and fp["impersonate"] not in globals.impersonate_list:
             fp["impersonate"] = random.choice(globals.impersonate_list)
-            globals.fp_map[req_token] = fp
-            with open(globals.FP_FILE, "w", encoding="utf-8") as f:
-                json.dump(globals.fp_map, f, indent=4)
+            changed = True
         if configs.user_agents_list and "user-agent" in fp.keys() and fp["user-agent"] not in configs.user_agents_list:
             fp["user-agent"] = random.choice(configs.user_agents_list)
+            changed = True
+        return changed
+
+    def reconcile_all(self):
+        changed = [token for token, fp in globals.fp_map.items() if is_valid_fp(fp) and self.reconcile(fp)]
+        self.cache.clear()
+        if changed:
+            globals.map_store.mark_changed("fp_map", *changed)
+            logger.info(f"Reconciled {len(changed)} fingerprints with the current config")
+
+    def get(self, req_token):
+        fp = self.cache.get(req_token)
+        if fp is not None:
+            return fp
+        fp = globals.fp_map.get(req_token, {})
+        if not is_valid_fp(fp):
+            fp = fp_pool.take()
+            if not req_token:
+                return fp
             globals.fp_map[req_token] = fp
-            with open(globals.FP_FILE, "w", encoding="utf-8") as f:
-                json.dump(globals.fp_map, f, indent=4)
+            globals.map_store.mark_changed("fp_map", req_token)
+        elif self.reconcile(fp):
+            globals.map_store.mark_changed("fp_map", req_token)
         fp = {k.lower(): v for k, v in fp.items()}
+        self.cache[req_token] = fp
         return fp
-    else:
-        options = Options(version_ranges={
-            'chrome': VersionRange(min_version=124),
-            'edge': VersionRange(min_version=124),
-        })
-        ua = ua_generator.generate(
-            device=configs.device_tuple if configs.device_tuple else ('desktop'),
-            browser=configs.browser_tuple if configs.browser_tuple else ('chrome', 'edge', 'firefox', 'safari'),
-            platform=configs.platform_tuple if configs.platform_tuple else ('windows', 'macos'),
-            options=options
-        )
-        fp = {
-            "user-agent": ua.text if not configs.user_agents_list else random.choice(configs.user_agents_list),
-            "impersonate": random.choice(globals.impersonate_list),
-            "proxy_url": random.choice(configs.proxy_url_list) if configs.proxy_url_list else None,
-            "oai-device-id": str(uuid.uuid4())
-        }
-        if ua.device == "desktop" and ua.browser in ("chrome", "edge"):
-            fp["sec-ch-ua-platform"] = ua.ch.platform
-            fp["sec-ch-ua"] = ua.ch.brands
-            fp["sec-ch-ua-mobile"] = ua.ch.mobile
-
-        if not req_token:
-            return fp
-        else:
-            globals.fp_map[req_token] = fp
-            with open(globals.FP_FILE, "w", encoding="utf-8") as f:
-                json.dump(globals.fp_map, f, indent=4)
-            return fp
+
+
+def is_valid_fp(fp):
+    return bool(fp and fp.get("user-agent") and fp.get("impersonate"))
+
+
+def generate_fp():
+    ua = ua_generator.generate(
+        device=configs.device_tuple if configs.device_tuple else ('desktop'),
+        browser=configs.browser_tuple if configs.browser_tuple else ('chrome', 'edge', 'firefox', 'safari'),
+        platform=configs.platform_tuple if configs.platform_tuple else ('windows', 'macos'),
+        options=FP_OPTIONS
+    )
+    fp = {
+        "user-agent": ua.text if not configs.user_agents_list else random.choice(configs.user_agents_list),
+        "impersonate": random.choice(globals.impersonate_list),
+        "proxy_url": random.choice(configs.proxy_url_list) if configs.proxy_url_list else None,
+        "oai-device-id": str(uuid.uuid4())
+    }
+    if ua.device == "desktop" and ua.browser in ("chrome", "edge"):
+        fp["sec-ch-ua-platform"] = ua.ch.platform
+        fp["sec-ch-ua"] = ua.ch.brands
+        fp["sec-ch-ua-mobile"] = ua.ch.mobile
+    return fp
+
+
+class FingerprintPool:
+    def __init__(self, size=128):
+        self.size = size
+        # every fingerprint carries its own device id, so each one is handed out once
+        self.ready = deque()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def take(self):
+        fp = self.ready.popleft() if self.ready else generate_fp()
+        if self.task is not None and len(self.ready) < self.size // 2:
+            self.wakeup.set()
+        return fp
+
+    async def fill_forever(self):
+        while True:
+            while len(self.ready) < self.size:
+                count = min(FP_BATCH, self.size - len(self.ready))
+                self.ready.extend(await asyncio.to_thread(lambda: [generate_fp() for _ in range(count)]))
+            self.wakeup.clear()
+            await self.wakeup.wait()
+
+    def start(self):
+        if self.size > 0 and (self.task is None or self.task.done()):
+            self.task = asyncio.get_running_loop().create_task(self.fill_forever())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+fp_pool = FingerprintPool(configs.fp_pool_size)
+fp_store = FingerprintStore()
+# another worker may rewrite a fingerprint in the shared state, the cached copy has to go with it
+globals.map_store.watch("fp_map", lambda token, present: fp_store.cache.pop(token, None))
+
+
+def get_fp(req_token):
+    return fp_store.get(req_token)
@@ -0,0 +1,139 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pybase64
+from fastapi import HTTPException
+
+from utils.Logger import logger
+
+MAX_ITERATIONS = 500000
+CANCEL_CHECK_INTERVAL = 2048
+
+cancel_flags = None
+
+
+def init_worker(flags):
+    global cancel_flags
+    cancel_flags = flags
+
+
+def solve_range(seed, diff, config, start=0, step=1, slot=None):
+    diff_len = len(diff)
+    static_config_part1 = (json.dumps(config[:3], separators=(',', ':'), ensure_ascii=False)[:-1] + ',').encode()
+    static_config_part2 = (',' + json.dumps(config[4:9], separators=(',', ':'), ensure_ascii=False)[1:-1] + ',').encode()
+    static_config_part3 = (',' + json.dumps(config[10:], separators=(',', ':'), ensure_ascii=False)[1:]).encode()
+
+    target_diff = bytes.fromhex(diff)
+
+    # base64 works on 3-byte groups, so the aligned head of part1 is encoded once and,
+    # together with the seed, absorbed into a hash state that is copied for every nonce
+    aligned = len(static_config_part1) - len(static_config_part1) % 3
+    prefix_encode = pybase64.b64encode(static_config_part1[:aligned])
+    head = static_config_part1[aligned:]
+    prefix_hash = hashlib.sha3_512(seed.encode() + prefix_encode)
+    copy_hash = prefix_hash.copy
+    b64encode = pybase64.b64encode
+
+    for n, i in enumerate(range(start, MAX_ITERATIONS, step)):
+        if slot is not None and n % CANCEL_CHECK_INTERVAL == 0 and cancel_flags[slot]:
+            return None
+        tail_encode = b64encode(b"%b%d%b%d%b" % (head, i, static_config_part2, i >> 1, static_config_part3))
+        hash_value = copy_hash()
+        hash_value.update(tail_encode)
+        if hash_value.digest()[:diff_len] <= target_diff:
+            return (prefix_encode + tail_encode).decode()
+    return None
+
+
+class PowSolverPool:
+    def __init__(self, workers, max_queue):
+        self.workers = max(workers, 1)
+        self.max_queue = max(max_queue, 1)
+        start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+        self.ctx = multiprocessing.get_context(start_method)
+        self.flags = None
+        self.executor = None
+        self.free_slots = list(range(self.max_queue))
+
+    def start(self):
+        if self.executor is None:
+            self.flags = self.ctx.Array('b', self.max_queue, lock=False)
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=self.ctx,
+                                                initializer=init_worker, initargs=(self.flags,))
+            logger.info(f"PoW solver pool started with {self.workers} workers")
+        return self.executor
+
+    def shutdown(self):
+        if self.executor is not None:
+            for slot in range(self.max_queue):
+                self.flags[slot] = 1
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def discard(self, executor):
+        # a broken pool is shut down so its manager thread and any surviving workers go with it
+        if executor is None:
+            return
+        if self.executor is executor:
+            self.executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    async def solve(self, seed, diff, config):
+        if not self.free_slots:
+            raise HTTPException(status_code=503, detail="Proof of work queue is full")
+        slot = self.free_slots.pop()
+        try:
+            executor = self.start()
+            self.flags[slot] = 0
+            futures = [executor.submit(solve_range, seed, diff, config, k, self.workers, slot)
+                       for k in range(self.workers)]
+        except BrokenProcessPool:
+            self.discard(self.executor)
+            self.free_slots.append(slot)
+            raise HTTPException(status_code=500, detail="Proof of work solver pool is broken")
+
+        pending = {asyncio.wrap_future(future) for future in futures}
+        answer = None
+        try:
+            while pending and answer is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future.cancelled():
+                        continue
+                    if isinstance(future.exception(), BrokenProcessPool):
+                        self.discard(executor)
+                        raise HTTPException(status_code=500, detail="Proof of work solver pool is broken")
+                    if future.exception() is None and future.result():
+                        answer = future.result()
+                        break
+            return answer
+        finally:
+            # stop sibling workers and abandoned jobs, the slot is reused once they have all exited
+            self.flags[slot] = 1
+            for future in futures:
+                future.cancel()
+            for future in pending:
+                future.cancel()
+            asyncio.get_running_loop().create_task(self.release(slot, futures))
+
+    async def release(self, slot, futures):
+        running = [asyncio.wrap_future(future) for future in futures if not future.done()]
+        if running:
+            # gathered rather than waited on, so the errors of a broken pool are retrieved instead of logged
+            await asyncio.gather(*running, return_exceptions=True)
+        self.free_slots.append(slot)
+
+    async def get_answer_token(self, seed, diff, config):
+        start = time.time()
+        answer = await self.solve(seed, diff, config)
+        end = time.time()
+        solved = answer is not None
+        logger.info(f'diff: {diff}, time: {int((end - start) * 1e6) / 1e3}ms, solved: {solved}, pool: {self.workers}')
+        if not solved:
+            answer = "wQ8Lk5FbGpA2NcR9dShT6gYjU7VxZ4D" + pybase64.b64encode(f'"{seed}"'.encode()).decode()
+        return "gAAAAAB" + answer, solved
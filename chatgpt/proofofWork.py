@@ -1,26 +1,40 @@
+import asyncio
 import hashlib
-import json
 import random
 import re
 import time
 import uuid
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta, timezone
 from html.parser import HTMLParser
 
 import pybase64
 import diskcache as dc
+from starlette.concurrency import run_in_threadpool
 
+from chatgpt.powSolver import PowSolverPool, solve_range
+from utils.Client import Client
 from utils.Logger import logger
-from utils.configs import conversation_only
+from utils.cache import LRUCache
+from utils.configs import conversation_only, pow_workers, pow_queue_size
 
 cores = [8, 16, 24, 32]
 timeLayout = "%a %b %d %Y %H:%M:%S"
 
 cache = dc.Cache('./data/pow_config_cache')
+config_cache = LRUCache(max_size=4096)
+config_cache_dpl = ""
+config_cache_scripts = []
+CONFIG_EXPIRE = 3600 * 24 * 7
 cached_scripts = []
 cached_dpl = ""
 cached_time = 0
 cached_require_proof = ""
+dpl_next_refresh = 0
+dpl_refresh_task = None
+DPL_REFRESH_AFTER = 12 * 60
+DPL_RETRY_AFTER = 60
+pow_solver = PowSolverPool(pow_workers, pow_queue_size) if pow_workers > 0 else None
 
 navigator_key = [
     "registerProtocolHandler−function registerProtocolHandler() { [native code] }",
@@ -375,56 +389,70 @@ window_key = [
 
 
 class ScriptSrcParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.scripts = []
+        self.dpl = ""
+
     def handle_starttag(self, tag, attrs):
-        global cached_scripts, cached_dpl, cached_time
         if tag == "script":
             attrs_dict = dict(attrs)
             if "src" in attrs_dict:
                 src = attrs_dict["src"]
-                cached_scripts.append(src)
+                self.scripts.append(src)
                 match = re.search(r"c/[^/]*/_", src)
                 if match:
-                    cached_dpl = match.group(0)
-                    cached_time = int(time.time())
+                    self.dpl = match.group(0)
 
 
 def get_data_build_from_html(html_content):
-    global cached_scripts, cached_dpl, cached_time
     parser = ScriptSrcParser()
     parser.feed(html_content)
-    if not cached_scripts:
-        cached_scripts.append("https://chatgpt.com/backend-api/sentinel/sdk.js")
-    if not cached_dpl:
+    scripts = parser.scripts or ["https://chatgpt.com/backend-api/sentinel/sdk.js"]
+    dpl = parser.dpl
+    if not dpl:
         match = re.search(r'<html[^>]*data-build="([^"]*)"', html_content)
         if match:
-            data_build = match.group(1)
-            cached_dpl = data_build
-            cached_time = int(time.time())
-            logger.info(f"Found dpl: {cached_dpl}")
+            dpl = match.group(1)
+    return scripts, dpl
 
 
-async def get_dpl(service):
-    global cached_scripts, cached_dpl, cached_time
-    if int(time.time()) - cached_time < 15 * 60:
-        return True
-    headers = service.base_headers.copy()
-    cached_scripts = []
-    cached_dpl = ""
+async def refresh_dpl(host_url, headers, proxy_url=None, impersonate="safari15_3"):
+    global cached_scripts, cached_dpl, cached_time, dpl_next_refresh
+    client = Client(proxy=proxy_url, impersonate=impersonate)
     try:
-        if conversation_only:
-            return True
-        r = await service.s.get(f"{service.host_url}/", headers=headers, timeout=5)
+        r = await client.get(f"{host_url}/", headers=headers, timeout=5)
         r.raise_for_status()
-        get_data_build_from_html(r.text)
-        if not cached_dpl:
+        scripts, dpl = get_data_build_from_html(r.text)
+        if not dpl:
             raise Exception("No Cached DPL")
-        else:
-            return True
+        # swap all three together so readers never see a half-filled script list
+        cached_scripts, cached_dpl, cached_time = scripts, dpl, int(time.time())
+        dpl_next_refresh = cached_time + DPL_REFRESH_AFTER
+        logger.info(f"Found dpl: {cached_dpl}")
     except Exception as e:
+        # keep serving the last good value and try again shortly
+        dpl_next_refresh = int(time.time()) + DPL_RETRY_AFTER
         logger.info(f"Failed to get dpl: {e}")
-        cached_dpl = None
-        cached_time = int(time.time())
+    finally:
+        await client.close()
+
+
+def start_dpl_refresh(host_url, headers, proxy_url=None, impersonate="safari15_3"):
+    global dpl_refresh_task
+    if conversation_only or int(time.time()) < dpl_next_refresh:
+        return False
+    if dpl_refresh_task and not dpl_refresh_task.done():
         return False
+    dpl_refresh_task = asyncio.get_event_loop().create_task(refresh_dpl(host_url, headers, proxy_url, impersonate))
+    return True
+
+
+async def get_dpl(service):
+    session_id = hashlib.md5(service.req_token.encode()).hexdigest()
+    proxy_url = service.proxy_url.replace("{}", session_id) if service.proxy_url else None
+    start_dpl_refresh(service.host_url, service.base_headers.copy(), proxy_url, service.impersonate)
+    return True
 
 
 def get_parse_time():
@@ -432,8 +460,8 @@ def get_parse_time():
     return now.strftime(timeLayout) + " GMT-0500 (Eastern Standard Time)"
 
 
-@cache.memoize(expire=3600 * 24 * 7)
-def get_config(user_agent, req_token=None):
+@cache.memoize(expire=CONFIG_EXPIRE)
+def load_config(user_agent, req_token=None):
     config = [
         random.choice([1920 + 1080, 2560 + 1440, 1920 + 1200, 2560 + 1600]),
         get_parse_time(),
@@ -457,6 +485,23 @@ def get_config(user_agent, req_token=None):
     return config
 
 
+def get_config(user_agent, req_token=None):
+    global config_cache_dpl, config_cache_scripts
+    if config_cache_dpl != cached_dpl or config_cache_scripts is not cached_scripts:
+        config_cache.clear()
+        config_cache_dpl, config_cache_scripts = cached_dpl, cached_scripts
+    key = (user_agent, req_token)
+    config = config_cache.get(key)
+    if config is None:
+        config = load_config(user_agent, req_token)
+        if cached_dpl and (config[6] != cached_dpl or config[5] not in cached_scripts):
+            # keep the per-token fingerprint, only move it to the current build
+            config = config[:5] + [random.choice(cached_scripts) if cached_scripts else "", cached_dpl] + config[7:]
+            cache.set(load_config.__cache_key__(user_agent, req_token), config, expire=CONFIG_EXPIRE)
+        config_cache.set(key, config)
+    return config
+
+
 def get_answer_token(seed, diff, config):
     start = time.time()
     answer, solved = generate_answer(seed, diff, config)
@@ -465,23 +510,16 @@ def get_answer_token(seed, diff, config):
     return "gAAAAAB" + answer, solved
 
 
+async def solve_answer_token(seed, diff, config):
+    if pow_solver:
+        return await pow_solver.get_answer_token(seed, diff, config)
+    return await run_in_threadpool(get_answer_token, seed, diff, config)
+
+
 def generate_answer(seed, diff, config):
-    diff_len = len(diff)
-    seed_encoded = seed.encode()
-    static_config_part1 = (json.dumps(config[:3], separators=(',', ':'), ensure_ascii=False)[:-1] + ',').encode()
-    static_config_part2 = (',' + json.dumps(config[4:9], separators=(',', ':'), ensure_ascii=False)[1:-1] + ',').encode()
-    static_config_part3 = (',' + json.dumps(config[10:], separators=(',', ':'), ensure_ascii=False)[1:]).encode()
-
-    target_diff = bytes.fromhex(diff)
-
-    for i in range(500000):
-        dynamic_json_i = str(i).encode()
-        dynamic_json_j = str(i >> 1).encode()
-        final_json_bytes = static_config_part1 + dynamic_json_i + static_config_part2 + dynamic_json_j + static_config_part3
-        base_encode = pybase64.b64encode(final_json_bytes)
-        hash_value = hashlib.sha3_512(seed_encoded + base_encode).digest()
-        if hash_value[:diff_len] <= target_diff:
-            return base_encode.decode(), True
+    answer = solve_range(seed, diff, config)
+    if answer is not None:
+        return answer, True
 
     return "wQ8Lk5FbGpA2NcR9dShT6gYjU7VxZ4D" + pybase64.b64encode(f'"{seed}"'.encode()).decode(), False
 
@@ -491,6 +529,47 @@ def get_requirements_token(config):
     return 'gAAAAAC' + require
 
 
+class RequirementsTokenPool:
+    def __init__(self, size=8, max_configs=1024):
+        self.size = size
+        self.max_configs = max_configs
+        self.pools = OrderedDict()
+        self.filling = set()
+        self.dpl = cached_dpl
+
+    def get(self, config):
+        if self.dpl != cached_dpl:
+            self.pools.clear()
+            self.dpl = cached_dpl
+        key = tuple(config)
+        tokens = self.pools.get(key)
+        if tokens is None:
+            tokens = self.pools[key] = deque()
+            while len(self.pools) > self.max_configs:
+                self.pools.popitem(last=False)
+        self.pools.move_to_end(key)
+        if len(tokens) <= self.size // 2 and key not in self.filling:
+            self.filling.add(key)
+            asyncio.get_event_loop().create_task(self.refill(key, config, self.dpl))
+        if tokens:
+            return tokens.popleft()
+        return get_requirements_token(config)
+
+    async def refill(self, key, config, dpl):
+        try:
+            count = self.size - len(self.pools.get(key, ()))
+            new_tokens = await run_in_threadpool(lambda: [get_requirements_token(config) for _ in range(count)])
+            if dpl == self.dpl and key in self.pools:
+                self.pools[key].extend(new_tokens)
+        except Exception as e:
+            logger.error(f"Failed to refill requirements tokens: {e}")
+        finally:
+            self.filling.discard(key)
+
+
+requirements_token_pool = RequirementsTokenPool()
+
+
 if __name__ == "__main__":
     # cached_scripts.append(
     #     "https://cdn.oaistatic.com/_next/static/cXh69klOLzS0Gy2joLDRS/_ssgManifest.js?dpl=453ebaec0d44c2decab71692e1bfe39be35a24b3")
@@ -0,0 +1,101 @@
+import asyncio
+import heapq
+import random
+import time
+
+from fastapi import HTTPException
+
+import utils.globals as globals
+from chatgpt.refreshToken import rt2ac, get_refresh_deadline
+from utils.Logger import logger
+from utils.configs import refresh_concurrency, refresh_before
+
+REFRESH_JITTER = 0.1
+RETRY_AFTER = 10 * 60
+
+
+def is_refresh_token(token):
+    return len(token) == 45
+
+
+class RefreshScheduler:
+    def __init__(self, concurrency=8, before=3600):
+        self.concurrency = max(concurrency, 1)
+        self.before = before
+        # min-heap of (due, refresh_token), stale when due no longer matches self.due
+        self.heap = []
+        self.due = {}
+        self.running = set()
+        # refreshes in progress, held here so they are not collected mid-run and stop() can cancel them
+        self.tasks = set()
+        self.wakeup = asyncio.Event()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.task = None
+
+    def schedule(self, refresh_token, due=None):
+        if not is_refresh_token(refresh_token) or globals.token_registry.is_error(refresh_token):
+            return
+        if due is None:
+            entry = globals.refresh_map.get(refresh_token)
+            if entry:
+                # jitter spreads a large pool out, and a token is never refreshed before half its lifetime
+                deadline = get_refresh_deadline(entry)
+                due = deadline - self.before * (1 + random.uniform(0, REFRESH_JITTER))
+                due = max(due, (entry.get("timestamp", 0) + deadline) / 2)
+            else:
+                due = time.time() + random.uniform(0, self.concurrency)
+        self.due[refresh_token] = due
+        heapq.heappush(self.heap, (due, refresh_token))
+        if self.heap[0][1] == refresh_token:
+            self.wakeup.set()
+
+    def start(self):
+        if self.task is None or self.task.done():
+            globals.token_registry.watch(self.schedule)
+            for token in globals.token_registry.list():
+                self.schedule(token)
+            self.task = asyncio.get_running_loop().create_task(self.run())
+            logger.info(f"Refresh scheduler started with {len(self.due)} refresh tokens")
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for task in self.tasks:
+            task.cancel()
+
+    async def run(self):
+        while True:
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                due, refresh_token = heapq.heappop(self.heap)
+                if self.due.get(refresh_token) != due or refresh_token in self.running:
+                    continue
+                del self.due[refresh_token]
+                self.running.add(refresh_token)
+                task = asyncio.create_task(self.refresh(refresh_token))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+            self.wakeup.clear()
+            timeout = min(self.heap[0][0] - now, 3600) if self.heap else 3600
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def refresh(self, refresh_token):
+        try:
+            async with self.semaphore:
+                if refresh_token not in globals.token_registry:
+                    return
+                force_refresh = refresh_token in globals.refresh_map
+                await rt2ac(refresh_token, force_refresh=force_refresh)
+                logger.info(f"Scheduled refresh of {refresh_token[:10]}... done")
+            self.schedule(refresh_token)
+        except HTTPException:
+            self.schedule(refresh_token, time.time() + RETRY_AFTER)
+        finally:
+            self.running.discard(refresh_token)
+
+
+refresh_scheduler = RefreshScheduler(refresh_concurrency, refresh_before)
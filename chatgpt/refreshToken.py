@@ -1,33 +1,113 @@
+import asyncio
 import hashlib
-import json
 import random
 import time
 
+import jwt
 from fastapi import HTTPException
 
 from utils.Client import Client
 from utils.Logger import logger
-from utils.configs import proxy_url_list
+from utils.configs import proxy_url_list, refresh_proxy_rate
 import utils.globals as globals
 
 
+REFRESH_FAILURE_TTL = 30
+ACCESS_TOKEN_VALIDITY = 5 * 24 * 60 * 60
+ACCESS_TOKEN_MARGIN = 5 * 60
+
+refreshing = {}
+refresh_failures = {}
+
+
+class ProxyRateLimiter:
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_slot = {}
+
+    async def wait(self, proxy):
+        if self.rate <= 0:
+            return
+        now = time.time()
+        slot = max(now, self.next_slot.get(proxy, 0))
+        self.next_slot[proxy] = slot + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+proxy_limiter = ProxyRateLimiter(refresh_proxy_rate)
+
+
+def add_error_token(token):
+    if globals.token_registry.is_error(token):
+        return
+    globals.error_token_list.append(token)
+    globals.token_registry.mark_error(token)
+    # errors tend to arrive in bursts during bulk jobs, the map store writes them out together
+    globals.map_store.mark_changed("error_token_list", token)
+
+
+def get_token_exp(access_token):
+    try:
+        return jwt.decode(access_token, options={"verify_signature": False}).get("exp")
+    except Exception:
+        return None
+
+
+def get_refresh_deadline(entry):
+    exp = get_token_exp(entry.get("token", ""))
+    if exp:
+        return exp
+    return entry.get("timestamp", 0) + ACCESS_TOKEN_VALIDITY
+
+
+def access_token_valid(entry):
+    return get_refresh_deadline(entry) - time.time() > ACCESS_TOKEN_MARGIN
+
+
 async def rt2ac(refresh_token, force_refresh=False):
-    if not force_refresh and (refresh_token in globals.refresh_map and int(time.time()) - globals.refresh_map.get(refresh_token, {}).get("timestamp", 0) < 5 * 24 * 60 * 60):
+    if not force_refresh and refresh_token in globals.refresh_map and access_token_valid(globals.refresh_map[refresh_token]):
         access_token = globals.refresh_map[refresh_token]["token"]
         # logger.info(f"refresh_token -> access_token from cache")
         return access_token
     else:
+        failure = refresh_failures.get(refresh_token)
+        if failure and failure[0] > time.time() and not force_refresh:
+            raise HTTPException(status_code=failure[1].status_code, detail=failure[1].detail)
+        # one exchange per refresh token, concurrent callers wait on the same task
+        task = refreshing.get(refresh_token)
+        if task is None:
+            task = asyncio.ensure_future(refresh_access_token(refresh_token))
+            refreshing[refresh_token] = task
+            task.add_done_callback(lambda t: refresh_done(refresh_token, t))
         try:
-            access_token = await chat_refresh(refresh_token)
-            globals.refresh_map[refresh_token] = {"token": access_token, "timestamp": int(time.time())}
-            with open(globals.REFRESH_MAP_FILE, "w") as f:
-                json.dump(globals.refresh_map, f, indent=4)
-            logger.info(f"refresh_token -> access_token with openai: {access_token}")
-            return access_token
+            return await asyncio.shield(task)
         except HTTPException as e:
             raise HTTPException(status_code=e.status_code, detail=e.detail)
 
 
+async def refresh_access_token(refresh_token):
+    access_token = await chat_refresh(refresh_token)
+    globals.refresh_map[refresh_token] = {"token": access_token, "timestamp": int(time.time())}
+    globals.map_store.mark_changed("refresh_map", refresh_token)
+    logger.info(f"refresh_token -> access_token with openai: {access_token}")
+    return access_token
+
+
+def refresh_done(refresh_token, task):
+    refreshing.pop(refresh_token, None)
+    if task.cancelled():
+        return
+    e = task.exception()
+    if isinstance(e, HTTPException):
+        refresh_failures[refresh_token] = (time.time() + REFRESH_FAILURE_TTL, e)
+    else:
+        refresh_failures.pop(refresh_token, None)
+    for token, (until, _) in list(refresh_failures.items()):
+        if until <= time.time():
+            del refresh_failures[token]
+
+
 async def chat_refresh(refresh_token):
     data = {
         "client_id": "pdlLIX2Y72MIl2rhLhTE9VV9bN905kBh",
@@ -36,7 +116,9 @@ async def chat_refresh(refresh_token):
         "refresh_token": refresh_token
     }
     session_id = hashlib.md5(refresh_token.encode()).hexdigest()
-    proxy_url = random.choice(proxy_url_list).replace("{}", session_id) if proxy_url_list else None
+    proxy = random.choice(proxy_url_list) if proxy_url_list else None
+    proxy_url = proxy.replace("{}", session_id) if proxy else None
+    await proxy_limiter.wait(proxy)
     client = Client(proxy=proxy_url)
     try:
         r = await client.post("https://auth0.openai.com/oauth/token", json=data, timeout=15)
@@ -45,10 +127,7 @@ async def chat_refresh(refresh_token):
             return access_token
         else:
             if "invalid_grant" in r.text or "access_denied" in r.text:
-                if refresh_token not in globals.error_token_list:
-                    globals.error_token_list.append(refresh_token)
-                    with open(globals.ERROR_TOKENS_FILE, "a", encoding="utf-8") as f:
-                        f.write(refresh_token + "\n")
+                add_error_token(refresh_token)
                 raise Exception(r.text)
             else:
                 raise Exception(r.text[:300])
@@ -0,0 +1,181 @@
+import heapq
+import itertools
+import time
+
+import utils.globals as globals
+from chatgpt.chatLimit import rate_limits
+from utils.configs import token_scheduler_name
+
+PERSONA_WEIGHTS = {
+    "chatgpt-paid": 4,
+    "chatgpt-freeaccount": 1,
+}
+RANDOM_ATTEMPTS = 8
+
+
+def is_limited(token, model):
+    return rate_limits.is_limited(token, model)
+
+
+class TokenScheduler:
+    def __init__(self, registry):
+        self.registry = registry
+        self.in_flight = {}
+        self.weights = {}
+
+    def select(self, model=None):
+        return self.registry.random()
+
+    def start(self, token):
+        self.in_flight[token] = self.in_flight.get(token, 0) + 1
+
+    def finish(self, token):
+        count = self.in_flight.get(token, 0) - 1
+        if count > 0:
+            self.in_flight[token] = count
+        else:
+            self.in_flight.pop(token, None)
+
+    def set_persona(self, token, persona):
+        self.weights[token] = PERSONA_WEIGHTS.get(persona, 1)
+
+
+class RandomScheduler(TokenScheduler):
+    def select(self, model=None):
+        for _ in range(RANDOM_ATTEMPTS):
+            token = self.registry.random()
+            if token is None or not is_limited(token, model):
+                return token
+        return self.registry.random()
+
+
+class RoundRobinScheduler(TokenScheduler):
+    def select(self, model=None):
+        for _ in range(len(self.registry)):
+            token = self.registry.next()
+            if not is_limited(token, model):
+                return token
+        return self.registry.next()
+
+
+class LeastBusyScheduler(TokenScheduler):
+    def __init__(self, registry):
+        super().__init__(registry)
+        # lazy min-heap of [load, seq, token, version], an entry is stale once its token's version moved on
+        self.heap = []
+        # a model with rate limited tokens gets a heap of its own, its limited tokens are parked by clear time
+        # instead of being skipped again on every select
+        self.models = {}
+        self.versions = {}
+        self.seq = itertools.count()
+        registry.watch(self.push)
+        for token in registry.list():
+            self.push(token)
+
+    def entry(self, token):
+        load = self.in_flight.get(token, 0) / self.weights.get(token, 1)
+        return load, next(self.seq), token, self.versions[token]
+
+    def push(self, token):
+        self.versions[token] = self.versions.get(token, 0) + 1
+        entry = self.entry(token)
+        heapq.heappush(self.heap, entry)
+        for model, state in self.models.items():
+            parked = state["parked"].get(token)
+            if parked is None:
+                heapq.heappush(state["heap"], entry)
+                continue
+            # a request on a parked token may have changed its limit, keep its clear time in step
+            clear_time = rate_limits.get(token, model)
+            if clear_time is None:
+                del state["parked"][token]
+                heapq.heappush(state["heap"], entry)
+            elif clear_time != parked:
+                state["parked"][token] = clear_time
+                heapq.heappush(state["clears"], (clear_time, token))
+        if len(self.heap) > 2 * len(self.versions) + 64:
+            self.compact()
+
+    def live(self, heap):
+        return [entry for entry in heap if self.versions.get(entry[2]) == entry[3]]
+
+    def compact(self):
+        self.heap = self.live(self.heap)
+        heapq.heapify(self.heap)
+        for state in self.models.values():
+            state["heap"] = self.live(state["heap"])
+            heapq.heapify(state["heap"])
+
+    def model_state(self, model, create=False):
+        state = self.models.get(model)
+        if state is None:
+            if not create:
+                return None
+            heap = self.live(self.heap)
+            heapq.heapify(heap)
+            state = self.models[model] = {"heap": heap, "parked": {}, "clears": []}
+        now = time.time()
+        while state["clears"] and state["clears"][0][0] <= now:
+            clear_time, token = heapq.heappop(state["clears"])
+            if state["parked"].get(token) == clear_time:
+                del state["parked"][token]
+                if token in self.registry:
+                    heapq.heappush(state["heap"], self.entry(token))
+        if not state["parked"] and not rate_limits.limited_tokens(model):
+            del self.models[model]
+            return None
+        return state
+
+    def select(self, model=None):
+        state = self.model_state(model)
+        heap = state["heap"] if state else self.heap
+        while heap:
+            _, _, candidate, version = heap[0]
+            if self.versions.get(candidate) != version or candidate not in self.registry:
+                heapq.heappop(heap)
+                continue
+            clear_time = rate_limits.get(candidate, model) if model else None
+            if clear_time is None:
+                return candidate
+            if state is None:
+                state = self.model_state(model, create=True)
+                heap = state["heap"]
+                continue
+            heapq.heappop(heap)
+            state["parked"][candidate] = clear_time
+            heapq.heappush(state["clears"], (clear_time, candidate))
+        if state and state["clears"]:
+            # every token is limited for this model, let the limit check answer with its clear time
+            return state["clears"][0][1]
+        return None
+
+    def start(self, token):
+        super().start(token)
+        if token in self.registry:
+            self.push(token)
+
+    def finish(self, token):
+        super().finish(token)
+        if token in self.registry:
+            self.push(token)
+
+    def set_persona(self, token, persona):
+        weight = PERSONA_WEIGHTS.get(persona, 1)
+        if self.weights.get(token, 1) != weight:
+            super().set_persona(token, persona)
+            if token in self.registry:
+                self.push(token)
+
+
+schedulers = {
+    "random": RandomScheduler,
+    "round_robin": RoundRobinScheduler,
+    "least_busy": LeastBusyScheduler,
+}
+
+
+def create_scheduler(name, registry):
+    return schedulers.get(name, RandomScheduler)(registry)
+
+
+token_scheduler = create_scheduler(token_scheduler_name, globals.token_registry)
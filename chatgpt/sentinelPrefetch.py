@@ -0,0 +1,77 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from utils.Logger import logger
+
+
+class SentinelPrefetcher:
+    def __init__(self, fetcher, ttl=60, hot_window=60, rate=1, max_tokens=256, concurrency=4):
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.hot_window = hot_window
+        self.rate = rate
+        self.max_tokens = max_tokens
+        self.semaphore = asyncio.Semaphore(max(concurrency, 1))
+        self.bundles = {}
+        # token -> last time a request used it, in the order they were last used
+        self.last_used = OrderedDict()
+        self.fetching = set()
+        self.next_slot = 0
+        self.skipped = 0
+
+    def take(self, req_token):
+        entry = self.bundles.pop(req_token, None)
+        if entry and entry[0] > time.time():
+            return entry[1]
+        return None
+
+    def watch(self, req_token, data, consumed=False):
+        # one bundle is fetched per request at most: after a prefetched one was used up, or when the
+        # token is back within the hot window, an idle token never gets more than the one it was left with
+        now = time.time()
+        last_used = self.last_used.pop(req_token, None)
+        self.last_used[req_token] = now
+        while len(self.last_used) > self.max_tokens:
+            token, _ = self.last_used.popitem(last=False)
+            self.bundles.pop(token, None)
+        if consumed or last_used is not None and now - last_used <= self.hot_window:
+            self.prefetch(req_token, data)
+
+    def acquire(self):
+        # a global cap on prefetches, a busy instance skips them rather than queueing upstream calls
+        if self.rate <= 0:
+            return True
+        now = time.time()
+        if self.next_slot > now + 1:
+            return False
+        self.next_slot = max(now, self.next_slot) + 1 / self.rate
+        return True
+
+    def prefetch(self, req_token, data):
+        entry = self.bundles.get(req_token)
+        if req_token in self.fetching or entry and entry[0] > time.time():
+            return
+        if not self.acquire():
+            self.skipped += 1
+            return
+        self.fetching.add(req_token)
+        asyncio.get_running_loop().create_task(self.fetch(req_token, data))
+
+    async def fetch(self, req_token, data):
+        try:
+            async with self.semaphore:
+                start = time.time()
+                bundle = await self.fetcher(req_token, data)
+            if req_token in self.last_used:
+                self.bundles[req_token] = (start + self.ttl, bundle)
+                logger.debug(f"Sentinel bundle prefetched in {int((time.time() - start) * 1000)}ms")
+        except Exception as e:
+            self.bundles.pop(req_token, None)
+            logger.debug(f"Sentinel prefetch failed: {e}")
+        finally:
+            self.fetching.discard(req_token)
+
+    def stop(self):
+        self.last_used.clear()
+        self.bundles.clear()
@@ -1,8 +1,17 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
 import pybase64
 import json
 import random
 import time
-from typing import Any, Callable, Dict, List, Union
+from typing import Any, List, Tuple, Union
+
+from starlette.concurrency import run_in_threadpool
+
+from utils.Logger import logger
+from utils.configs import turnstile_workers
 
 
 class OrderedMap:
@@ -20,9 +29,24 @@ class OrderedMap:
 
 
 TurnTokenList = List[List[Any]]
-FloatMap = Dict[float, Any]
-StringMap = Dict[str, Any]
-FuncType = Callable[..., Any]
+Program = List[Tuple[Any, Any]]
+
+SPECIAL_CASES = {
+    "window.Math": "[object Math]",
+    "window.Reflect": "[object Reflect]",
+    "window.performance": "[object Performance]",
+    "window.localStorage": "[object Storage]",
+    "window.Object": "function Object() { [native code] }",
+    "window.Reflect.set": "function set() { [native code] }",
+    "window.performance.now": "function () { [native code] }",
+    "window.Object.create": "function create() { [native code] }",
+    "window.Object.keys": "function keys() { [native code] }",
+    "window.Math.random": "function random() { [native code] }"
+}
+
+LOCAL_STORAGE_KEYS = ["STATSIG_LOCAL_STORAGE_INTERNAL_STORE_V4", "STATSIG_LOCAL_STORAGE_STABLE_ID",
+                      "client-correlated-secret", "oai/apps/capExpiresAt", "oai-did",
+                      "STATSIG_LOCAL_STORAGE_LOGGING_REQUEST", "UiState.isNavigationCollapsed.1"]
 
 
 def get_turnstile_token(dx: str, p: str) -> Union[str, None]:
@@ -35,14 +59,16 @@ def get_turnstile_token(dx: str, p: str) -> Union[str, None]:
 
 
 def process_turnstile_token(dx: str, p: str) -> str:
-    result = []
     p_length = len(p)
-    if p_length != 0:
-        for i, r in enumerate(dx):
-            result.append(chr(ord(r) ^ ord(p[i % p_length])))
-    else:
-        result = list(dx)
-    return ''.join(result)
+    if p_length == 0:
+        return dx
+    if dx.isascii() and p.isascii():
+        # xor the whole buffer as one big integer instead of char by char
+        length = len(dx)
+        key = (p * (length // p_length + 1))[:length]
+        xored = int.from_bytes(dx.encode(), "big") ^ int.from_bytes(key.encode(), "big")
+        return xored.to_bytes(length, "big").decode()
+    return "".join(chr(ord(r) ^ ord(p[i % p_length])) for i, r in enumerate(dx))
 
 
 def is_slice(input_val: Any) -> bool:
@@ -63,201 +89,192 @@ def to_str(input_val: Any) -> str:
     elif is_float(input_val):
         return str(input_val)
     elif is_string(input_val):
-        special_cases = {
-            "window.Math": "[object Math]",
-            "window.Reflect": "[object Reflect]",
-            "window.performance": "[object Performance]",
-            "window.localStorage": "[object Storage]",
-            "window.Object": "function Object() { [native code] }",
-            "window.Reflect.set": "function set() { [native code] }",
-            "window.performance.now": "function () { [native code] }",
-            "window.Object.create": "function create() { [native code] }",
-            "window.Object.keys": "function keys() { [native code] }",
-            "window.Math.random": "function random() { [native code] }"
-        }
-        return special_cases.get(input_val, input_val)
+        return SPECIAL_CASES.get(input_val, input_val)
     elif isinstance(input_val, list) and all(isinstance(item, str) for item in input_val):
         return ','.join(input_val)
     else:
         return str(input_val)
 
 
-def get_func_map() -> FloatMap:
-    process_map: FloatMap = {}
+def compile_turnstile(dx: str, p: str) -> Union[Tuple[TurnTokenList, Program], None]:
+    tokens = get_turnstile_token(dx, p)
+    if tokens is None:
+        return None
+    token_list = json.loads(tokens)
+    # split every instruction into (register, operands) once, malformed ones could never dispatch
+    program = [(token[0], token[1:]) for token in token_list if isinstance(token, (list, str)) and token]
+    return token_list, program
+
+
+class TurnstileVM:
+    def __init__(self, token_list: TurnTokenList, p: str):
+        self.start_time = time.time()
+        self.result = ""
+        # the program can copy handlers into other registers and call them from there,
+        # so the dispatch table lives in the same register file as the data
+        self.regs = {
+            1: self.op_xor, 2: self.op_set, 3: self.op_result, 5: self.op_add, 6: self.op_location,
+            7: self.op_call, 8: self.op_copy, 9: token_list, 10: "window", 14: self.op_json_parse,
+            15: self.op_json_dump, 16: p, 17: self.op_call_assign, 18: self.op_atob, 19: self.op_btoa,
+            20: self.op_call_if_equal, 21: self.op_noop, 23: self.op_call_if_defined, 24: self.op_property,
+        }
+
+    def run(self, program: Program) -> str:
+        regs = self.regs
+        for op, args in program:
+            try:
+                f = regs.get(op)
+                if callable(f):
+                    f(*args)
+            except Exception:
+                pass
+        return self.result
+
+    def op_xor(self, e, t):
+        regs = self.regs
+        regs[e] = process_turnstile_token(to_str(regs[e]), to_str(regs[t]))
 
-    def func_1(e: float, t: float):
-        e_str = to_str(process_map[e])
-        t_str = to_str(process_map[t])
-        res = process_turnstile_token(e_str, t_str)
-        process_map[e] = res
+    def op_set(self, e, t):
+        self.regs[e] = t
 
-    def func_2(e: float, t: Any):
-        process_map[e] = t
+    def op_result(self, e):
+        self.result = pybase64.b64encode(e.encode()).decode()
 
-    def func_5(e: float, t: float):
-        n = process_map[e]
-        tres = process_map[t]
+    def op_add(self, e, t):
+        regs = self.regs
+        n = regs[e]
+        tres = regs[t]
         if is_slice(n):
-            nt = n + [tres]
-            process_map[e] = nt
+            regs[e] = n + [tres]
+        elif is_string(n) or is_string(tres):
+            regs[e] = to_str(n) + to_str(tres)
+        elif is_float(n) and is_float(tres):
+            regs[e] = n + tres
         else:
-            if is_string(n) or is_string(tres):
-                res = to_str(n) + to_str(tres)
-            elif is_float(n) and is_float(tres):
-                res = n + tres
-            else:
-                res = "NaN"
-            process_map[e] = res
-
-    def func_6(e: float, t: float, n: float):
-        tv = process_map[t]
-        nv = process_map[n]
+            regs[e] = "NaN"
+
+    def op_location(self, e, t, n):
+        regs = self.regs
+        tv = regs[t]
+        nv = regs[n]
         if is_string(tv) and is_string(nv):
             res = f"{tv}.{nv}"
-            if res == "window.document.location":
-                process_map[e] = "https://chatgpt.com/"
-            else:
-                process_map[e] = res
-        else:
-            print("func type 6 error")
+            regs[e] = "https://chatgpt.com/" if res == "window.document.location" else res
 
-    def func_24(e: float, t: float, n: float):
-        tv = process_map[t]
-        nv = process_map[n]
+    def op_property(self, e, t, n):
+        regs = self.regs
+        tv = regs[t]
+        nv = regs[n]
         if is_string(tv) and is_string(nv):
-            process_map[e] = f"{tv}.{nv}"
-        else:
-            print("func type 24 error")
+            regs[e] = f"{tv}.{nv}"
 
-    def func_7(e: float, *args):
-        n = [process_map[arg] for arg in args]
-        ev = process_map[e]
+    def op_call(self, e, *args):
+        regs = self.regs
+        n = [regs[arg] for arg in args]
+        ev = regs[e]
         if isinstance(ev, str):
             if ev == "window.Reflect.set":
-                obj = n[0]
-                key_str = str(n[1])
-                val = n[2]
-                obj.add(key_str, val)
+                n[0].add(str(n[1]), n[2])
         elif callable(ev):
             ev(*n)
 
-    def func_17(e: float, t: float, *args):
-        i = [process_map[arg] for arg in args]
-        tv = process_map[t]
+    def op_call_assign(self, e, t, *args):
+        regs = self.regs
+        i = [regs[arg] for arg in args]
+        tv = regs[t]
         res = None
         if isinstance(tv, str):
             if tv == "window.performance.now":
-                current_time = time.time_ns()
-                elapsed_ns = current_time - int(start_time * 1e9)
+                elapsed_ns = time.time_ns() - int(self.start_time * 1e9)
                 res = (elapsed_ns + random.random()) / 1e6
             elif tv == "window.Object.create":
                 res = OrderedMap()
             elif tv == "window.Object.keys":
                 if isinstance(i[0], str) and i[0] == "window.localStorage":
-                    res = ["STATSIG_LOCAL_STORAGE_INTERNAL_STORE_V4", "STATSIG_LOCAL_STORAGE_STABLE_ID",
-                           "client-correlated-secret", "oai/apps/capExpiresAt", "oai-did",
-                           "STATSIG_LOCAL_STORAGE_LOGGING_REQUEST", "UiState.isNavigationCollapsed.1"]
+                    res = list(LOCAL_STORAGE_KEYS)
             elif tv == "window.Math.random":
                 res = random.random()
         elif callable(tv):
             res = tv(*i)
-        process_map[e] = res
+        regs[e] = res
 
-    def func_8(e: float, t: float):
-        process_map[e] = process_map[t]
+    def op_copy(self, e, t):
+        regs = self.regs
+        regs[e] = regs[t]
 
-    def func_14(e: float, t: float):
-        tv = process_map[t]
+    def op_json_parse(self, e, t):
+        regs = self.regs
+        tv = regs[t]
         if is_string(tv):
-            token_list = json.loads(tv)
-            process_map[e] = token_list
-        else:
-            print("func type 14 error")
-
-    def func_15(e: float, t: float):
-        tv = process_map[t]
-        process_map[e] = json.dumps(tv)
-
-    def func_18(e: float):
-        ev = process_map[e]
-        e_str = to_str(ev)
-        decoded = pybase64.b64decode(e_str).decode()
-        process_map[e] = decoded
-
-    def func_19(e: float):
-        ev = process_map[e]
-        e_str = to_str(ev)
-        encoded = pybase64.b64encode(e_str.encode()).decode()
-        process_map[e] = encoded
-
-    def func_20(e: float, t: float, n: float, *args):
-        o = [process_map[arg] for arg in args]
-        ev = process_map[e]
-        tv = process_map[t]
-        if ev == tv:
-            nv = process_map[n]
+            regs[e] = json.loads(tv)
+
+    def op_json_dump(self, e, t):
+        regs = self.regs
+        regs[e] = json.dumps(regs[t])
+
+    def op_atob(self, e):
+        regs = self.regs
+        regs[e] = pybase64.b64decode(to_str(regs[e])).decode()
+
+    def op_btoa(self, e):
+        regs = self.regs
+        regs[e] = pybase64.b64encode(to_str(regs[e]).encode()).decode()
+
+    def op_call_if_equal(self, e, t, n, *args):
+        regs = self.regs
+        o = [regs[arg] for arg in args]
+        if regs[e] == regs[t]:
+            nv = regs[n]
             if callable(nv):
                 nv(*o)
-            else:
-                print("func type 20 error")
 
-    def func_21(*args):
+    def op_noop(self, *args):
         pass
 
-    def func_23(e: float, t: float, *args):
-        i = list(args)
-        ev = process_map[e]
-        tv = process_map[t]
-        if ev is not None:
-            if callable(tv):
-                tv(*i)
+    def op_call_if_defined(self, e, t, *args):
+        regs = self.regs
+        ev = regs[e]
+        tv = regs[t]
+        if ev is not None and callable(tv):
+            tv(*args)
 
-    process_map.update({
-        1: func_1, 2: func_2, 5: func_5, 6: func_6, 24: func_24, 7: func_7,
-        17: func_17, 8: func_8, 10: "window", 14: func_14, 15: func_15,
-        18: func_18, 19: func_19, 20: func_20, 21: func_21, 23: func_23
-    })
 
-    return process_map
+def process_turnstile(dx: str, p: str) -> str:
+    compiled = compile_turnstile(dx, p)
+    if compiled is None:
+        return ""
+    token_list, program = compiled
+    return TurnstileVM(token_list, p).run(program)
 
-start_time = 0
 
+turnstile_executor = None
 
-def process_turnstile(dx: str, p: str) -> str:
-    global start_time
-    start_time = time.time()
-    tokens = get_turnstile_token(dx, p)
-    if tokens is None:
-        return ""
 
-    token_list = json.loads(tokens)
-    # print(token_list)
-    res = ""
-    process_map = get_func_map()
-
-    def func_3(e: str):
-        nonlocal res
-        res = pybase64.b64encode(e.encode()).decode()
-
-    process_map[3] = func_3
-    process_map[9] = token_list
-    process_map[16] = p
-
-    for token in token_list:
-        try:
-            e = token[0]
-            t = token[1:]
-            f = process_map.get(e)
-            if callable(f):
-                f(*t)
-            else:
-                pass
-                # print(f"Warning: No function found for key {e}")
-        except Exception as exc:
-            pass
-            # print(f"Error processing token {token}: {exc}")
+def start_turnstile_executor():
+    global turnstile_executor
+    if turnstile_executor is None:
+        start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+        turnstile_executor = ProcessPoolExecutor(max_workers=turnstile_workers,
+                                                 mp_context=multiprocessing.get_context(start_method))
+        logger.info(f"Turnstile solver pool started with {turnstile_workers} workers")
+    return turnstile_executor
 
-    return res
+
+def shutdown_turnstile_executor():
+    global turnstile_executor
+    if turnstile_executor is not None:
+        turnstile_executor.shutdown(wait=False, cancel_futures=True)
+        turnstile_executor = None
+
+
+async def solve_turnstile_token(dx: str, p: str) -> Union[str, None]:
+    start = time.time()
+    if turnstile_workers > 0:
+        token = await asyncio.wrap_future(start_turnstile_executor().submit(process_turnstile, dx, p))
+    else:
+        token = await run_in_threadpool(process_turnstile, dx, p)
+    logger.info(f"Turnstile solved locally in {int((time.time() - start) * 1e6) / 1e3}ms")
+    return token or None
 
 
 if __name__ == "__main__":
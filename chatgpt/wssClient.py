@@ -1,15 +1,9 @@
-import json
 import time
 
 from utils.Logger import logger
 import utils.globals as globals
 
 
-def save_wss_map(wss_map):
-    with open(globals.WSS_MAP_FILE, "w") as f:
-        json.dump(wss_map, f, indent=4)
-
-
 async def token2wss(token):
     if not token:
         return False, None
@@ -32,5 +26,5 @@ async def set_wss(token, wss_mode, wss_url=None):
     if not token:
         return True
     globals.wss_map[token] = {"timestamp": int(time.time()), "wss_url": wss_url, "wss_mode": wss_mode}
-    save_wss_map(globals.wss_map)
+    globals.map_store.mark_changed("wss_map", token)
     return True
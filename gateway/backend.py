@@ -8,20 +8,21 @@ import uuid
 from fastapi import Request, HTTPException
 from fastapi.responses import RedirectResponse, StreamingResponse, Response
 from starlette.background import BackgroundTask
-from starlette.concurrency import run_in_threadpool
 
 import utils.globals as globals
 from app import app
 from chatgpt.authorization import verify_token
 from chatgpt.fp import get_fp
-from chatgpt.proofofWork import get_answer_token, get_config, get_requirements_token
+from chatgpt.proofofWork import solve_answer_token, get_config, requirements_token_pool
+from chatgpt.turnstile import solve_turnstile_token
 from gateway.chatgpt import chatgpt_html
 from gateway.reverseProxy import chatgpt_reverse_proxy, content_generator, get_real_req_token, headers_reject_list, \
     headers_accept_list
 from utils.Client import Client
 from utils.Logger import logger
+from utils.cache import LRUCache
 from utils.configs import x_sign, turnstile_solver_url, chatgpt_base_url_list, no_sentinel, sentinel_proxy_url_list, \
-    force_no_history
+    force_no_history, local_turnstile
 
 banned_paths = [
     "backend-api/accounts/logout_all",
@@ -47,6 +48,7 @@ async def check_account(request: Request):
     if len(token) == 45 or token.startswith("eyJhbGciOi"):
         return check_account_response
     else:
+        await globals.map_store.wait_loaded("seed_map")
         check_account_str = check_account_response.body.decode('utf-8')
         check_account_info = json.loads(check_account_str)
         for key in check_account_info.get("accounts", {}).keys():
@@ -54,8 +56,7 @@ async def check_account(request: Request):
             globals.seed_map[token]["user_id"] = \
                 check_account_info["accounts"][key]["account"]["account_user_id"].split("__")[0]
             check_account_info["accounts"][key]["account"]["account_user_id"] = f"user-chatgpt__{account_id}"
-        with open(globals.SEED_MAP_FILE, "w", encoding="utf-8") as f:
-            json.dump(globals.seed_map, f, indent=4)
+        globals.map_store.mark_changed("seed_map", token)
         return check_account_info
 
 
@@ -136,6 +137,7 @@ async def get_conversations(request: Request):
     token = request.headers.get("Authorization", "").replace("Bearer ", "")
     if len(token) == 45 or token.startswith("eyJhbGciOi"):
         return await chatgpt_reverse_proxy(request, "backend-api/conversations")
+    await globals.map_store.wait_loaded("seed_map", "conversation_map")
     if request.method == "GET":
         limit = int(request.query_params.get("limit", 28))
         offset = int(request.query_params.get("offset", 0))
@@ -171,6 +173,7 @@ async def update_conversation(request: Request, conversation_id: str):
     if len(token) == 45 or token.startswith("eyJhbGciOi"):
         return conversation_details_response
     else:
+        await globals.map_store.wait_loaded("seed_map", "conversation_map")
         conversation_details_str = conversation_details_response.body.decode('utf-8')
         conversation_details = json.loads(conversation_details_str)
         if conversation_id in globals.seed_map[token][
@@ -183,8 +186,7 @@ async def update_conversation(request: Request, conversation_id: str):
             globals.conversation_map[conversation_id]["gizmo_id"] = conversation_details.get("gizmo_id", None)
             globals.conversation_map[conversation_id]["async_status"] = conversation_details.get("async_status",
                                                                                                  None)
-            with open(globals.CONVERSATION_MAP_FILE, "w", encoding="utf-8") as f:
-                json.dump(globals.conversation_map, f, indent=4)
+            globals.map_store.mark_changed("conversation_map", conversation_id)
         return conversation_details_response
 
 
@@ -195,18 +197,17 @@ async def patch_conversation(request: Request, conversation_id: str):
     if len(token) == 45 or token.startswith("eyJhbGciOi"):
         return patch_response
     else:
+        await globals.map_store.wait_loaded("seed_map", "conversation_map")
         data = await request.json()
         if conversation_id in globals.seed_map[token][
             "conversations"] and conversation_id in globals.conversation_map:
             if not data.get("is_visible", True):
                 globals.conversation_map.pop(conversation_id)
                 globals.seed_map[token]["conversations"].remove(conversation_id)
-                with open(globals.SEED_MAP_FILE, "w", encoding="utf-8") as f:
-                    json.dump(globals.seed_map, f, indent=4)
+                globals.map_store.mark_changed("seed_map", token)
             else:
                 globals.conversation_map[conversation_id].update(data)
-            with open(globals.CONVERSATION_MAP_FILE, "w", encoding="utf-8") as f:
-                json.dump(globals.conversation_map, f, indent=4)
+            globals.map_store.mark_changed("conversation_map", conversation_id)
         return patch_response
 
 
@@ -438,8 +439,9 @@ async def edge():
 
 
 if no_sentinel:
-    openai_sentinel_tokens_cache = {}
-    openai_sentinel_cookies_cache = {}
+    # chat tokens are spent by the next conversation request, the oai-sc cookie lives longer
+    openai_sentinel_tokens_cache = LRUCache(max_size=4096, ttl=5 * 60)
+    openai_sentinel_cookies_cache = LRUCache(max_size=4096, ttl=24 * 60 * 60)
 
     @app.post("/backend-api/sentinel/chat-requirements")
     async def sentinel_chat_conversations(request: Request):
@@ -478,10 +480,10 @@ if no_sentinel:
 
         try:
             config = get_config(user_agent, session_id)
-            p = get_requirements_token(config)
+            p = requirements_token_pool.get(config)
             data = {'p': p}
             for cookie in openai_sentinel_cookies_cache.get(req_token, []):
-                clients.session.cookies.set(**cookie)
+                clients.cookies.set(**cookie)
             r = await clients.post(f'{host_url}/backend-api/sentinel/chat-requirements', headers=headers, json=data, timeout=10)
             oai_sc = r.cookies.get("oai-sc")
             if oai_sc:
@@ -494,7 +496,9 @@ if no_sentinel:
             if turnstile_required:
                 turnstile_dx = turnstile.get("dx")
                 try:
-                    if turnstile_solver_url:
+                    if local_turnstile:
+                        turnstile_token = await solve_turnstile_token(turnstile_dx, p)
+                    elif turnstile_solver_url:
                         res = await client.post(turnstile_solver_url,
                                                 json={"url": "https://chatgpt.com", "p": p, "dx": turnstile_dx, "ua": user_agent})
                         turnstile_token = res.json().get("t")
@@ -506,8 +510,8 @@ if no_sentinel:
             if proofofwork_required:
                 proofofwork_diff = proofofwork.get("difficulty")
                 proofofwork_seed = proofofwork.get("seed")
-                proof_token, solved = await run_in_threadpool(
-                    get_answer_token, proofofwork_seed, proofofwork_diff, config
+                proof_token, solved = await solve_answer_token(
+                    proofofwork_seed, proofofwork_diff, config
                 )
                 if not solved:
                     raise HTTPException(status_code=403, detail="Failed to solve proof of work")
@@ -520,6 +524,9 @@ if no_sentinel:
             }
         except Exception as e:
             logger.error(f"Sentinel failed: {e}")
+        finally:
+            await client.close()
+            await clients.close()
 
         return {
             "arkose": {
@@ -568,6 +575,15 @@ if no_sentinel:
         headers.update(fp)
         headers.update({"authorization": f"Bearer {access_token}"})
 
+        async def c_close(client, clients):
+            if client:
+                await client.close()
+                del client
+            if clients:
+                await clients.close()
+                del clients
+
+        client = clients = None
         try:
             session_id = hashlib.md5(req_token.encode()).hexdigest()
             proxy_url = proxy_url.replace("{}", session_id) if proxy_url else None
@@ -582,7 +598,7 @@ if no_sentinel:
             openai_sentinel_tokens_cache.pop(req_token, None)
             if not sentinel_tokens:
                 config = get_config(user_agent, session_id)
-                p = get_requirements_token(config)
+                p = requirements_token_pool.get(config)
                 data = {'p': p}
                 r = await clients.post(f'{host_url}/backend-api/sentinel/chat-requirements', headers=headers, json=data,
                                        timeout=10)
@@ -592,7 +608,9 @@ if no_sentinel:
                 if turnstile_required:
                     turnstile_dx = turnstile.get("dx")
                     try:
-                        if turnstile_solver_url:
+                        if local_turnstile:
+                            turnstile_token = await solve_turnstile_token(turnstile_dx, p)
+                        elif turnstile_solver_url:
                             res = await client.post(turnstile_solver_url,
                                                     json={"url": "https://chatgpt.com", "p": p, "dx": turnstile_dx, "ua": user_agent})
                             turnstile_token = res.json().get("t")
@@ -604,8 +622,8 @@ if no_sentinel:
                 if proofofwork_required:
                     proofofwork_diff = proofofwork.get("difficulty")
                     proofofwork_seed = proofofwork.get("seed")
-                    proof_token, solved = await run_in_threadpool(
-                        get_answer_token, proofofwork_seed, proofofwork_diff, config
+                    proof_token, solved = await solve_answer_token(
+                        proofofwork_seed, proofofwork_diff, config
                     )
                     if not solved:
                         raise HTTPException(status_code=403, detail="Failed to solve proof of work")
@@ -623,20 +641,13 @@ if no_sentinel:
                 })
         except Exception as e:
             logger.error(f"Sentinel failed: {e}")
+            await c_close(client, clients)
             return Response(status_code=403, content="Sentinel failed")
 
         params = dict(request.query_params)
         data = await request.body()
         request_cookies = dict(request.cookies)
 
-        async def c_close(client, clients):
-            if client:
-                await client.close()
-                del client
-            if clients:
-                await clients.close()
-                del clients
-
         history = True
         try:
             req_json = json.loads(data)
@@ -650,24 +661,28 @@ if no_sentinel:
             data = json.dumps(req_json).encode("utf-8")
 
         background = BackgroundTask(c_close, client, clients)
-        r = await client.post_stream(f"{host_url}{request.url.path}", params=params, headers=headers,
-                                     cookies=request_cookies, data=data, stream=True, allow_redirects=False)
-        rheaders = r.headers
-        logger.info(f"Request token: {req_token}")
-        logger.info(f"Request proxy: {proxy_url}")
-        logger.info(f"Request UA: {user_agent}")
-        logger.info(f"Request impersonate: {impersonate}")
-        if x_sign:
-            rheaders.update({"x-sign": x_sign})
-        if 'stream' in rheaders.get("content-type", ""):
-            conv_key = r.cookies.get("conv_key", "")
-            response = StreamingResponse(content_generator(r, token, history), headers=rheaders,
-                                         media_type=r.headers.get("content-type", ""), background=background)
-            response.set_cookie("conv_key", value=conv_key)
-            return response
-        else:
-            return Response(content=(await r.atext()), headers=rheaders, media_type=rheaders.get("content-type"),
-                            status_code=r.status_code, background=background)
+        try:
+            r = await client.post_stream(f"{host_url}{request.url.path}", params=params, headers=headers,
+                                         cookies=request_cookies, data=data, stream=True, allow_redirects=False)
+            rheaders = r.headers
+            logger.info(f"Request token: {req_token}")
+            logger.info(f"Request proxy: {proxy_url}")
+            logger.info(f"Request UA: {user_agent}")
+            logger.info(f"Request impersonate: {impersonate}")
+            if x_sign:
+                rheaders.update({"x-sign": x_sign})
+            if 'stream' in rheaders.get("content-type", ""):
+                conv_key = r.cookies.get("conv_key", "")
+                response = StreamingResponse(content_generator(r, token, history), headers=rheaders,
+                                             media_type=r.headers.get("content-type", ""), background=background)
+                response.set_cookie("conv_key", value=conv_key)
+                return response
+            else:
+                return Response(content=(await r.atext()), headers=rheaders, media_type=rheaders.get("content-type"),
+                                status_code=r.status_code, background=background)
+        except Exception:
+            await c_close(client, clients)
+            raise
 
 
 @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD", "PATCH", "TRACE"])
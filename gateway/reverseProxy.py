@@ -92,6 +92,8 @@ headers_accept_list = [
 
 
 async def get_real_req_token(token):
+    # seeds resolve to tokens and their conversations get saved, neither may be read half loaded
+    await globals.map_store.wait_loaded("seed_map", "conversation_map")
     req_token = get_req_token(token)
     if len(req_token) == 45 or req_token.startswith("eyJhbGciOi"):
         return req_token
@@ -118,10 +120,8 @@ def save_conversation(token, conversation_id, title=None):
     else:
         globals.seed_map[token]["conversations"].remove(conversation_id)
         globals.seed_map[token]["conversations"].insert(0, conversation_id)
-    with open(globals.CONVERSATION_MAP_FILE, "w", encoding="utf-8") as f:
-        json.dump(globals.conversation_map, f, indent=4)
-    with open(globals.SEED_MAP_FILE, "w", encoding="utf-8") as f:
-        json.dump(globals.seed_map, f, indent=4)
+    globals.map_store.mark_changed("conversation_map", conversation_id)
+    globals.map_store.mark_changed("seed_map", token)
     if title:
         logger.info(f"Conversation ID: {conversation_id}, Title: {title}")
 
@@ -40,6 +40,7 @@ def verify_authorization(bearer_token):
 @app.get("/seedtoken")
 async def get_seedtoken(request: Request, credentials: HTTPAuthorizationCredentials = Security(security_scheme)):
     verify_authorization(credentials.credentials)
+    await globals.map_store.wait_loaded("seed_map")
     try:
         params = request.query_params
         seed = params.get("seed")
@@ -68,6 +69,7 @@ async def get_seedtoken(request: Request, credentials: HTTPAuthorizationCredenti
 @app.post("/seedtoken")
 async def set_seedtoken(request: Request, credentials: HTTPAuthorizationCredentials = Security(security_scheme)):
     verify_authorization(credentials.credentials)
+    await globals.map_store.wait_loaded("seed_map")
     data = await request.json()
 
     seed = data.get("seed")
@@ -81,8 +83,7 @@ async def set_seedtoken(request: Request, credentials: HTTPAuthorizationCredenti
     else:
         globals.seed_map[seed]["token"] = token
 
-    with open(globals.SEED_MAP_FILE, "w", encoding="utf-8") as f:
-        json.dump(globals.seed_map, f, indent=4)
+    globals.map_store.mark_changed("seed_map", seed)
 
     return {"status": "success", "message": "Token updated successfully"}
 
@@ -90,6 +91,7 @@ async def set_seedtoken(request: Request, credentials: HTTPAuthorizationCredenti
 @app.delete("/seedtoken")
 async def delete_seedtoken(request: Request, credentials: HTTPAuthorizationCredentials = Security(security_scheme)):
     verify_authorization(credentials.credentials)
+    await globals.map_store.wait_loaded("seed_map")
 
     try:
         data = await request.json()
@@ -97,8 +99,7 @@ async def delete_seedtoken(request: Request, credentials: HTTPAuthorizationCrede
 
         if seed == "clear":
             globals.seed_map.clear()
-            with open(globals.SEED_MAP_FILE, "w", encoding="utf-8") as f:
-                json.dump(globals.seed_map, f, indent=4)
+            globals.map_store.mark_dirty("seed_map")
             return {"status": "success", "message": "All seeds deleted successfully"}
 
         if not seed:
@@ -108,8 +109,7 @@ async def delete_seedtoken(request: Request, credentials: HTTPAuthorizationCrede
             raise HTTPException(status_code=404, detail=f"Seed '{seed}' not found")
         del globals.seed_map[seed]
 
-        with open(globals.SEED_MAP_FILE, "w", encoding="utf-8") as f:
-            json.dump(globals.seed_map, f, indent=4)
+        globals.map_store.mark_changed("seed_map", seed)
 
         return {
             "status": "success",
@@ -124,7 +124,7 @@ async def delete_seedtoken(request: Request, credentials: HTTPAuthorizationCrede
 
 async def chatgpt_account_check(access_token):
     auth_info = {}
-    client = Client(proxy=random.choice(proxy_url_list) if proxy_url_list else None)
+    client = None
     try:
         host_url = random.choice(chatgpt_base_url_list) if chatgpt_base_url_list else "https://chatgpt.com"
         req_token = await get_real_req_token(access_token)
@@ -181,7 +181,8 @@ async def chatgpt_account_check(access_token):
         logger.error(f"chatgpt_account_check: {e}")
         return {}
     finally:
-        await client.close()
+        if client:
+            await client.close()
 
 
 async def chatgpt_refresh(refresh_token):
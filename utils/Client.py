@@ -1,6 +1,108 @@
-import random
+import asyncio
+import inspect
+import time
+from collections import OrderedDict
 
-from curl_cffi.requests import AsyncSession
+from curl_cffi.requests import AsyncSession, Cookies
+
+from utils.Logger import logger
+from utils.configs import session_pool_size, session_idle_timeout, session_max_clients
+
+
+# PooledSession hooks a private method, it is checked against the curl_cffi version pinned in requirements.txt
+# so an upgrade that changes it fails on startup instead of leaking cookies between clients
+if list(inspect.signature(AsyncSession._parse_response).parameters) != \
+        ["self", "curl", "buffer", "header_buffer", "default_encoding"]:
+    raise RuntimeError("Unsupported curl_cffi version, install the one pinned in requirements.txt")
+
+
+class PooledSession(AsyncSession):
+    def _parse_response(self, curl, buffer, header_buffer, default_encoding):
+        # keep the shared jar empty, cookies belong to the Client that sent the request
+        shared_cookies = self.cookies
+        self.cookies = Cookies()
+        try:
+            rsp = super()._parse_response(curl, buffer, header_buffer, default_encoding)
+        finally:
+            self.cookies = shared_cookies
+        return rsp
+
+
+class SessionPool:
+    def __init__(self, max_size=64, idle_timeout=300, max_clients=64):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_clients = max_clients
+        self.sessions = OrderedDict()
+        self.last_reap = time.time()
+
+    def acquire(self, proxy, impersonate, verify):
+        # a session runs at most max_clients requests at once, a busy one gets an overflow session
+        # for the same proxy and fingerprint instead of queueing the requests behind it
+        shard = 0
+        while True:
+            key = (proxy, impersonate, verify, shard)
+            entry = self.sessions.get(key)
+            if entry is None or entry["refs"] < self.max_clients:
+                break
+            shard += 1
+        created = entry is None
+        if created:
+            session = PooledSession(proxies={"http": proxy, "https": proxy}, impersonate=impersonate,
+                                    verify=verify, max_clients=self.max_clients)
+            entry = {"session": session, "refs": 0, "last_used": time.time()}
+            self.sessions[key] = entry
+        self.sessions.move_to_end(key)
+        entry["refs"] += 1
+        entry["last_used"] = time.time()
+        if created:
+            # the new session already holds its ref, when every other one is in use the pool runs over max_size
+            # until they are released instead of closing the session it just handed out
+            self.evict()
+        if time.time() - self.last_reap > self.idle_timeout:
+            self.last_reap = time.time()
+            asyncio.get_event_loop().create_task(self.reap())
+        return key, entry["session"]
+
+    def release(self, key):
+        entry = self.sessions.get(key)
+        if entry:
+            entry["refs"] = max(entry["refs"] - 1, 0)
+            entry["last_used"] = time.time()
+
+    def evict(self):
+        for key in list(self.sessions.keys()):
+            if len(self.sessions) <= self.max_size:
+                break
+            if self.sessions[key]["refs"] == 0:
+                self.close_session(self.sessions.pop(key)["session"])
+
+    async def reap(self):
+        now = time.time()
+        for key in list(self.sessions.keys()):
+            entry = self.sessions.get(key)
+            if entry and entry["refs"] == 0 and now - entry["last_used"] > self.idle_timeout:
+                self.sessions.pop(key)
+                await entry["session"].close()
+        logger.debug(f"Session pool size: {len(self.sessions)}")
+
+    @staticmethod
+    def close_session(session):
+        try:
+            asyncio.get_event_loop().create_task(session.close())
+        except Exception:
+            pass
+
+    async def close(self):
+        while self.sessions:
+            _, entry = self.sessions.popitem()
+            try:
+                await entry["session"].close()
+            except Exception:
+                pass
+
+
+session_pool = SessionPool(session_pool_size, session_idle_timeout, session_max_clients)
 
 
 class Client:
@@ -15,42 +117,54 @@ class Client:
         # self.ja3 = ""
         # self.akamai = ""
         # ja3=self.ja3, akamai=self.akamai
-        self.session = AsyncSession(proxies=self.proxies, timeout=self.timeout, impersonate=self.impersonate, verify=self.verify)
-        self.session2 = AsyncSession(proxies=self.proxies, timeout=self.timeout, impersonate=self.impersonate, verify=self.verify)
+        self.key, self.session = session_pool.acquire(proxy, self.impersonate, self.verify)
+        self.cookies = Cookies()
+        # streamed responses end with the client, the pooled session it sent them through outlives it
+        self.streams = []
+
+    async def _request(self, method, *args, cookies=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        if cookies:
+            request_cookies = Cookies(self.cookies)
+            request_cookies.update(cookies)
+        else:
+            request_cookies = self.cookies
+        r = await self.session.request(method, *args, cookies=request_cookies, **kwargs)
+        if kwargs.get("stream"):
+            self.streams.append(r)
+        self.cookies.update(r.cookies)
+        return r
 
     async def post(self, *args, **kwargs):
-        r = await self.session.post(*args, **kwargs)
+        r = await self._request("POST", *args, **kwargs)
         return r
 
     async def post_stream(self, *args, headers=None, cookies=None, **kwargs):
-        if self.session:
-            headers = headers or self.session.headers
-            cookies = cookies or self.session.cookies
-        r = await self.session2.post(*args, headers=headers, cookies=cookies, **kwargs)
+        r = await self._request("POST", *args, headers=headers, cookies=cookies, **kwargs)
         return r
 
     async def get(self, *args, **kwargs):
-        r = await self.session.get(*args, **kwargs)
+        r = await self._request("GET", *args, **kwargs)
         return r
 
     async def request(self, *args, **kwargs):
-        r = await self.session.request(*args, **kwargs)
+        r = await self._request(*args, **kwargs)
         return r
 
     async def put(self, *args, **kwargs):
-        r = await self.session.put(*args, **kwargs)
+        r = await self._request("PUT", *args, **kwargs)
         return r
 
     async def close(self):
-        if hasattr(self, 'session'):
-            try:
-                await self.session.close()
-                del self.session
-            except Exception:
-                pass
-        if hasattr(self, 'session2'):
+        if self.session is None:
+            return
+        self.session = None
+        while self.streams:
+            r = self.streams.pop()
             try:
-                await self.session2.close()
-                del self.session2
+                # stops a transfer nobody reads anymore, aclose then waits for it to wind down
+                r.close()
+                await r.aclose()
             except Exception:
                 pass
+        session_pool.release(self.key)
@@ -0,0 +1,132 @@
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache(OrderedDict):
+    # a dict in recency order, so the global maps can be swapped for one without touching their callers
+    def __init__(self, max_size=1024, ttl=0):
+        super().__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> expiry in the order keys were last set, the oldest one sits in front
+        self.expires = OrderedDict()
+        # set by the map store for persisted maps, evicted entries are spilled to it and read back on a miss
+        self.backing = None
+        self.name = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = 0
+
+    def resident(self, key):
+        return OrderedDict.__contains__(self, key) and not self.expired(key)
+
+    def expired(self, key):
+        if self.ttl and key in self.expires and self.expires[key] <= time.time():
+            self.pop(key)
+            self.evictions += 1
+            return True
+        return False
+
+    def load(self, key):
+        if self.backing is None:
+            return False
+        value = self.backing.fetch(self.name, key)
+        if value is MISSING:
+            return False
+        self.loads += 1
+        self[key] = value
+        return True
+
+    def __getitem__(self, key):
+        if self.resident(key):
+            self.hits += 1
+            self.move_to_end(key)
+            return dict.__getitem__(self, key)
+        self.misses += 1
+        if self.load(key):
+            return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.resident(key) or self.load(key)
+
+    def __setitem__(self, key, value):
+        OrderedDict.__setitem__(self, key, value)
+        self.move_to_end(key)
+        if self.ttl:
+            self.expires[key] = time.time() + self.ttl
+            self.expires.move_to_end(key)
+        if self.max_size:
+            while len(self) > self.max_size:
+                evicted = next(iter(self))
+                value = self.remove(evicted)
+                self.evictions += 1
+                if self.backing is not None:
+                    self.backing.spill(self.name, evicted, value)
+
+    def set(self, key, value):
+        self[key] = value
+
+    def remove(self, key):
+        # drops a resident entry without going through the overridden lookups
+        value = dict.__getitem__(self, key)
+        OrderedDict.__delitem__(self, key)
+        self.expires.pop(key, None)
+        return value
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def pop(self, key, *default):
+        if not OrderedDict.__contains__(self, key) and not self.load(key):
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self.remove(key)
+        if self.backing is not None:
+            self.backing.discard(self.name, key)
+        return value
+
+    def popitem(self, last=True):
+        if not self:
+            raise KeyError("dictionary is empty")
+        key = next(reversed(self)) if last else next(iter(self))
+        return key, self.pop(key)
+
+    def clear(self):
+        OrderedDict.clear(self)
+        self.expires.clear()
+        if self.backing is not None:
+            self.backing.discard_all(self.name)
+
+    def evict_expired(self, now=None):
+        now = now or time.time()
+        evicted = 0
+        while self.expires:
+            key, expires = next(iter(self.expires.items()))
+            if expires > now:
+                break
+            self.pop(key)
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def stats(self):
+        return {
+            "size": len(self),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "loads": self.loads,
+        }
@@ -41,17 +41,41 @@ platform_tuple_str = os.getenv('PLATFORM_TUPLE', '()')
 
 cf_file_url = os.getenv('CF_FILE_URL', None)
 turnstile_solver_url = os.getenv('TURNSTILE_SOLVER_URL', None)
+local_turnstile = is_true(os.getenv('LOCAL_TURNSTILE', False))
+turnstile_workers = int(os.getenv('TURNSTILE_WORKERS', 0))
 
 history_disabled = is_true(os.getenv('HISTORY_DISABLED', True))
 pow_difficulty = os.getenv('POW_DIFFICULTY', '000032')
+pow_workers = int(os.getenv('POW_WORKERS', os.cpu_count() or 1))
+pow_queue_size = int(os.getenv('POW_QUEUE_SIZE', 32))
+challenge_timeout = int(os.getenv('CHALLENGE_TIMEOUT', 20))
 retry_times = int(os.getenv('RETRY_TIMES', 3))
 conversation_only = is_true(os.getenv('CONVERSATION_ONLY', False))
 enable_limit = is_true(os.getenv('ENABLE_LIMIT', True))
 upload_by_url = is_true(os.getenv('UPLOAD_BY_URL', False))
 check_model = is_true(os.getenv('CHECK_MODEL', False))
 scheduled_refresh = is_true(os.getenv('SCHEDULED_REFRESH', False))
+refresh_concurrency = int(os.getenv('REFRESH_CONCURRENCY', 8))
+refresh_before = int(os.getenv('REFRESH_BEFORE', 3600))
+refresh_proxy_rate = float(os.getenv('REFRESH_PROXY_RATE', 0))
+refresh_on_startup = is_true(os.getenv('REFRESH_ON_STARTUP', False))
 random_token = is_true(os.getenv('RANDOM_TOKEN', True))
+token_scheduler_name = os.getenv('TOKEN_SCHEDULER', 'random' if random_token else 'round_robin')
 oai_language = os.getenv('OAI_LANGUAGE', 'zh-CN')
+session_pool_size = int(os.getenv('SESSION_POOL_SIZE', 64))
+session_idle_timeout = int(os.getenv('SESSION_IDLE_TIMEOUT', 300))
+session_max_clients = int(os.getenv('SESSION_MAX_CLIENTS', 64))
+sentinel_prefetch = is_true(os.getenv('SENTINEL_PREFETCH', False))
+sentinel_prefetch_ttl = int(os.getenv('SENTINEL_PREFETCH_TTL', 60))
+sentinel_prefetch_hot = int(os.getenv('SENTINEL_PREFETCH_HOT', 60))
+sentinel_prefetch_rate = float(os.getenv('SENTINEL_PREFETCH_RATE', 1))
+fp_pool_size = int(os.getenv('FP_POOL_SIZE', 128))
+delta_encoding = is_true(os.getenv('DELTA_ENCODING', True))
+cache_max_entries = int(os.getenv('CACHE_MAX_ENTRIES', 10000))
+persist_interval = float(os.getenv('PERSIST_INTERVAL', 5))
+persist_threshold = int(os.getenv('PERSIST_THRESHOLD', 100))
+persist_compact = int(os.getenv('PERSIST_COMPACT', 1000))
+state_backend = os.getenv('STATE_BACKEND', 'json').lower()
 
 authorization_list = authorization.split(',') if authorization else []
 chatgpt_base_url_list = chatgpt_base_url.split(',') if chatgpt_base_url else []
@@ -88,17 +112,41 @@ logger.info("FILE_HOST:     " + str(file_host))
 logger.info("VOICE_HOST:    " + str(voice_host))
 logger.info("IMPERSONATE:       " + str(impersonate_list))
 logger.info("USER_AGENTS:       " + str(user_agents_list))
+logger.info("SESSION_POOL_SIZE: " + str(session_pool_size))
+logger.info("SESSION_IDLE_TIMEOUT: " + str(session_idle_timeout))
+logger.info("SESSION_MAX_CLIENTS: " + str(session_max_clients))
 logger.info("---------------------- Functionality -----------------------")
 logger.info("HISTORY_DISABLED:  " + str(history_disabled))
 logger.info("POW_DIFFICULTY:    " + str(pow_difficulty))
+logger.info("POW_WORKERS:       " + str(pow_workers))
+logger.info("POW_QUEUE_SIZE:    " + str(pow_queue_size))
+logger.info("CHALLENGE_TIMEOUT: " + str(challenge_timeout))
+logger.info("LOCAL_TURNSTILE:   " + str(local_turnstile))
+logger.info("TURNSTILE_WORKERS: " + str(turnstile_workers))
 logger.info("RETRY_TIMES:       " + str(retry_times))
 logger.info("CONVERSATION_ONLY: " + str(conversation_only))
 logger.info("ENABLE_LIMIT:      " + str(enable_limit))
 logger.info("UPLOAD_BY_URL:     " + str(upload_by_url))
 logger.info("CHECK_MODEL:       " + str(check_model))
 logger.info("SCHEDULED_REFRESH: " + str(scheduled_refresh))
+logger.info("REFRESH_CONCURRENCY: " + str(refresh_concurrency))
+logger.info("REFRESH_BEFORE:    " + str(refresh_before))
+logger.info("REFRESH_PROXY_RATE: " + str(refresh_proxy_rate))
+logger.info("REFRESH_ON_STARTUP: " + str(refresh_on_startup))
 logger.info("RANDOM_TOKEN:      " + str(random_token))
+logger.info("TOKEN_SCHEDULER:   " + str(token_scheduler_name))
 logger.info("OAI_LANGUAGE:      " + str(oai_language))
+logger.info("SENTINEL_PREFETCH: " + str(sentinel_prefetch))
+logger.info("SENTINEL_PREFETCH_TTL: " + str(sentinel_prefetch_ttl))
+logger.info("SENTINEL_PREFETCH_HOT: " + str(sentinel_prefetch_hot))
+logger.info("SENTINEL_PREFETCH_RATE: " + str(sentinel_prefetch_rate))
+logger.info("FP_POOL_SIZE: " + str(fp_pool_size))
+logger.info("DELTA_ENCODING: " + str(delta_encoding))
+logger.info("CACHE_MAX_ENTRIES: " + str(cache_max_entries))
+logger.info("PERSIST_INTERVAL: " + str(persist_interval))
+logger.info("PERSIST_THRESHOLD: " + str(persist_threshold))
+logger.info("PERSIST_COMPACT: " + str(persist_compact))
+logger.info("STATE_BACKEND: " + str(state_backend))
 logger.info("------------------------- Gateway --------------------------")
 logger.info("ENABLE_GATEWAY:    " + str(enable_gateway))
 logger.info("AUTO_SEED:         " + str(auto_seed))
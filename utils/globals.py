@@ -3,6 +3,9 @@ import os
 
 import utils.configs as configs
 from utils.Logger import logger
+from utils.cache import LRUCache
+from utils.persist import create_store
+from utils.registry import TokenRegistry
 
 DATA_FOLDER = "data"
 TOKENS_FILE = os.path.join(DATA_FOLDER, "token.txt")
@@ -12,15 +15,17 @@ WSS_MAP_FILE = os.path.join(DATA_FOLDER, "wss_map.json")
 FP_FILE = os.path.join(DATA_FOLDER, "fp_map.json")
 SEED_MAP_FILE = os.path.join(DATA_FOLDER, "seed_map.json")
 CONVERSATION_MAP_FILE = os.path.join(DATA_FOLDER, "conversation_map.json")
+STATE_DB_FILE = os.path.join(DATA_FOLDER, "state.db")
+SPILL_DB_FILE = os.path.join(DATA_FOLDER, "spill.db")
 
-count = 0
 token_list = []
 error_token_list = []
-refresh_map = {}
-wss_map = {}
-fp_map = {}
+# the bounded maps keep their least recently used entries on disk, wss urls are only trusted for an hour anyway
+refresh_map = LRUCache(configs.cache_max_entries)
+wss_map = LRUCache(configs.cache_max_entries, ttl=60 * 60)
+fp_map = LRUCache(configs.cache_max_entries)
 seed_map = {}
-conversation_map = {}
+conversation_map = LRUCache(configs.cache_max_entries)
 impersonate_list = [
     "chrome99",
     "chrome100",
@@ -39,68 +44,45 @@ impersonate_list = [
 if not os.path.exists(DATA_FOLDER):
     os.makedirs(DATA_FOLDER)
 
-if os.path.exists(REFRESH_MAP_FILE):
-    with open(REFRESH_MAP_FILE, "r") as f:
-        try:
-            refresh_map = json.load(f)
-        except:
-            refresh_map = {}
-else:
-    refresh_map = {}
 
-if os.path.exists(WSS_MAP_FILE):
-    with open(WSS_MAP_FILE, "r") as f:
+def load_json(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
         try:
-            wss_map = json.load(f)
+            return json.load(f)
         except:
-            wss_map = {}
-else:
-    wss_map = {}
+            return {}
 
-if os.path.exists(FP_FILE):
-    with open(FP_FILE, "r", encoding="utf-8") as f:
-        try:
-            fp_map = json.load(f)
-        except:
-            fp_map = {}
-else:
-    fp_map = {}
 
-if os.path.exists(SEED_MAP_FILE):
-    with open(SEED_MAP_FILE, "r") as f:
-        try:
-            seed_map = json.load(f)
-        except:
-            seed_map = {}
-else:
-    seed_map = {}
+def load_lines(path):
+    if not os.path.exists(path):
+        with open(path, "w", encoding="utf-8") as f:
+            pass
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
 
-if os.path.exists(CONVERSATION_MAP_FILE):
-    with open(CONVERSATION_MAP_FILE, "r") as f:
-        try:
-            conversation_map = json.load(f)
-        except:
-            conversation_map = {}
-else:
-    conversation_map = {}
 
-if os.path.exists(TOKENS_FILE):
-    with open(TOKENS_FILE, "r", encoding="utf-8") as f:
-        for line in f:
-            if line.strip() and not line.startswith("#"):
-                token_list.append(line.strip())
-else:
-    with open(TOKENS_FILE, "w", encoding="utf-8") as f:
-        pass
+map_store = create_store(configs.state_backend, STATE_DB_FILE, SPILL_DB_FILE, configs.persist_interval,
+                         configs.persist_threshold, configs.persist_compact)
+# the maps are filled through the store, so entries over CACHE_MAX_ENTRIES are spilled rather than dropped;
+# once the state database exists it is the source of truth and the files are only read to import them
+map_store.register("refresh_map", REFRESH_MAP_FILE, lambda: refresh_map, loader=lambda: load_json(REFRESH_MAP_FILE))
+map_store.register("wss_map", WSS_MAP_FILE, lambda: wss_map, loader=lambda: load_json(WSS_MAP_FILE))
+map_store.register("fp_map", FP_FILE, lambda: fp_map, journal=True, loader=lambda: load_json(FP_FILE))
+# seeds and conversations are the large ones, they load in the background after startup
+map_store.register("seed_map", SEED_MAP_FILE, lambda: seed_map, journal=True,
+                   loader=lambda: load_json(SEED_MAP_FILE), lazy=True)
+map_store.register("conversation_map", CONVERSATION_MAP_FILE, lambda: conversation_map, journal=True,
+                   loader=lambda: load_json(CONVERSATION_MAP_FILE), lazy=True)
+map_store.register("token_list", TOKENS_FILE, lambda: token_list, lines=True, loader=lambda: load_lines(TOKENS_FILE),
+                   on_sync=lambda token, present: token_registry.add(token) if present else token_registry.remove(token))
+map_store.register("error_token_list", ERROR_TOKENS_FILE, lambda: error_token_list, lines=True,
+                   loader=lambda: load_lines(ERROR_TOKENS_FILE),
+                   on_sync=lambda token, present: token_registry.mark_error(token) if present else token_registry.errors.discard(token))
 
-if os.path.exists(ERROR_TOKENS_FILE):
-    with open(ERROR_TOKENS_FILE, "r", encoding="utf-8") as f:
-        for line in f:
-            if line.strip() and not line.startswith("#"):
-                error_token_list.append(line.strip())
-else:
-    with open(ERROR_TOKENS_FILE, "w", encoding="utf-8") as f:
-        pass
+token_registry = TokenRegistry(token_list, error_token_list)
 
 if token_list:
     logger.info(f"Token list count: {len(token_list)}, Error token list count: {len(error_token_list)}")
@@ -0,0 +1,557 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from utils.Logger import logger
+from utils.cache import LRUCache, MISSING
+
+
+def write_json_atomic(path, content):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def replay_journal(path, data):
+    count = 0
+    if not os.path.exists(path):
+        return count
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # a torn last line from a crash mid-append
+                continue
+            if "c" in entry:
+                data.clear()
+            elif "v" in entry:
+                data[entry["k"]] = entry["v"]
+            else:
+                data.pop(entry["k"], None)
+            count += 1
+    return count
+
+
+def connect_spill(path):
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS spill (name TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                 "PRIMARY KEY (name, key)) WITHOUT ROWID")
+    return conn
+
+
+def fill(data, loaded):
+    if isinstance(data, list):
+        data.extend(loaded)
+    else:
+        data.update(loaded)
+
+
+class MapStore:
+    def __init__(self, interval=5, threshold=100, compact_size=1000, spill_path=None):
+        self.interval = interval
+        self.threshold = threshold
+        self.compact_size = compact_size
+        # entries evicted from the bounded maps leave the json files for this database
+        self.spill_path = spill_path
+        self.spill_reader = None
+        self.spill_writer = None
+        # name -> (path, getter), the getter follows the module global when it is rebound
+        self.maps = {}
+        # name -> [journal path, entries since the last compaction]
+        self.journals = {}
+        # token files are plain lists, one item per line
+        self.lists = set()
+        # name -> callback(key, present) for entries another worker changed
+        self.on_sync = {}
+        self.dirty = set()
+        self.changed = {}
+        self.changes = 0
+        # name -> {key: value, MISSING once deleted} evicted since the last flush, and maps cleared since then
+        self.spilled = {}
+        self.cleared = set()
+        # the same for the flush being written, a miss still has to find those entries, and the changes
+        # it carries so a failed write can put them back
+        self.writing = ({}, set(), set(), {})
+        # name -> reader for maps that are loaded after startup, their writes wait until then
+        self.loading = {}
+        self.ready = asyncio.Event()
+        self.load_task = None
+        self.lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def register(self, name, path, getter, journal=False, lines=False, on_sync=None, loader=None, lazy=False):
+        self.maps[name] = (path, getter)
+        if lines:
+            self.lists.add(name)
+        if journal:
+            self.journals[name] = [os.path.splitext(path)[0] + ".journal", 0]
+        self.watch(name, on_sync)
+        self.attach(name, getter())
+        if lazy:
+            self.loading[name] = lambda: self.read(name, loader())
+        elif loader is not None:
+            fill(getter(), self.read(name, loader()))
+        elif journal:
+            self.read(name, getter())
+
+    def watch(self, name, on_sync):
+        self.on_sync[name] = on_sync
+
+    def attach(self, name, data):
+        # an expiring map only caches what upstream hands out again, its evicted entries are simply dropped
+        if isinstance(data, LRUCache) and data.max_size and not data.ttl and self.spill_path:
+            data.backing, data.name = self, name
+
+    def read(self, name, data):
+        if name in self.journals:
+            count = replay_journal(self.journals[name][0], data)
+            if count:
+                logger.info(f"Replayed {count} journal entries into {name}")
+            self.journals[name][1] = count
+        return data
+
+    async def load(self):
+        try:
+            for name, read in list(self.loading.items()):
+                start = time.time()
+                loaded = await asyncio.to_thread(read)
+                # anything written while loading is newer than the file
+                data = self.maps[name][1]()
+                spilled = self.spilled.get(name, {})
+                for key, value in loaded.items():
+                    if not dict.__contains__(data, key) and key not in spilled:
+                        data[key] = value
+                del self.loading[name]
+                logger.info(f"Loaded {len(loaded)} {name} entries in {time.time() - start:.2f}s")
+        except Exception as e:
+            logger.error(f"Failed to load state: {e}")
+        finally:
+            self.loading.clear()
+            self.ready.set()
+
+    def is_ready(self):
+        return self.ready.is_set()
+
+    async def wait_loaded(self, *names):
+        if self.loading.keys() & set(names):
+            await self.ready.wait()
+
+    def mark_dirty(self, *names):
+        self.dirty.update(names)
+        self.changed_by(len(names))
+
+    def mark_changed(self, name, *keys):
+        self.track(name, keys)
+        self.changed_by(len(keys))
+
+    def track(self, name, keys):
+        if name in self.journals or name in self.lists:
+            self.changed.setdefault(name, {}).update(dict.fromkeys(keys))
+        else:
+            self.dirty.add(name)
+
+    def changed_by(self, count):
+        self.changes += count
+        if self.task is None:
+            # nothing flushes in the background outside the app, keep the old write-through behaviour
+            self.flush_sync()
+        elif self.changes >= self.threshold:
+            self.wakeup.set()
+
+    def is_pending(self, name, key):
+        return name in self.dirty or key in self.changed.get(name, ())
+
+    def spill(self, name, key, value):
+        # the entry moves from the map file to the spill file, the next flush writes both
+        self.spilled.setdefault(name, {})[key] = value
+        self.track(name, (key,))
+        self.changes += 1
+
+    def discard(self, name, key):
+        if key in self.spilled.get(name, ()) or self.spill_reader is not None or os.path.exists(self.spill_path or ""):
+            self.spilled.setdefault(name, {})[key] = MISSING
+
+    def discard_all(self, name):
+        self.spilled.pop(name, None)
+        self.cleared.add(name)
+
+    def fetch(self, name, key):
+        # the newest copy wins: not yet flushed, being flushed, then on disk
+        for spilled, cleared, *_ in ((self.spilled, self.cleared), self.writing):
+            entries = spilled.get(name, {})
+            if key in entries:
+                return entries[key]
+            if name in cleared:
+                return MISSING
+        return self.read_spilled(name, key)
+
+    def read_spilled(self, name, key):
+        if self.spill_reader is None:
+            if not os.path.exists(self.spill_path):
+                return MISSING
+            self.spill_reader = connect_spill(self.spill_path)
+        row = self.spill_reader.execute("SELECT value FROM spill WHERE name = ? AND key = ?", (name, key)).fetchone()
+        return json.loads(row[0]) if row else MISSING
+
+    def take_spills(self, names):
+        spills = {name: self.spilled.pop(name) for name in names & self.spilled.keys()}
+        cleared = self.cleared & names
+        self.cleared -= cleared
+        return spills, cleared
+
+    def requeue(self):
+        # a job failed and the ones after it were skipped, everything the flush carried is pending again
+        spills, cleared, dirty, changed = self.writing
+        for name, entries in spills.items():
+            pending = self.spilled.setdefault(name, {})
+            for key, value in entries.items():
+                pending.setdefault(key, value)
+        self.cleared |= cleared - self.spilled.keys()
+        self.requeue_changes(dirty, changed)
+
+    def requeue_changes(self, dirty, changed):
+        # the write may have stopped halfway through a file, so the maps are written out in full
+        self.dirty |= dirty | changed.keys()
+
+    def take_changes(self):
+        dirty, changed = self.dirty, self.changed
+        self.dirty, self.changed, self.changes = set(), {}, 0
+        # a map that is still loading would be written out half empty, hold its changes back
+        for name in self.loading.keys() & (dirty | changed.keys()):
+            if name in dirty:
+                dirty.discard(name)
+                self.dirty.add(name)
+            if name in changed:
+                self.changed[name] = changed.pop(name)
+        return dirty, changed
+
+    def snapshot(self):
+        # serialize on the loop so no handler mutates a map halfway through, write off the loop
+        dirty, changed = self.take_changes()
+        jobs = []
+        spills, cleared = self.take_spills((self.spilled.keys() | self.cleared) - self.loading.keys())
+        if spills or cleared:
+            # evicted entries reach the spill file before the map files stop holding them
+            jobs.append(("spill", self.spill_path, (spills, cleared)))
+        self.writing = (spills, cleared, dirty, changed)
+        for name in dirty | changed.keys():
+            path, getter = self.maps[name]
+            data = getter()
+            if isinstance(data, LRUCache):
+                data.evict_expired()
+            if name in self.lists:
+                if name in dirty:
+                    jobs.append(("replace", path, "".join(item + "\n" for item in data)))
+                else:
+                    jobs.append(("append", path, "".join(item + "\n" for item in changed[name])))
+                continue
+            if name not in self.journals:
+                jobs.append(("replace", path, json.dumps(data, indent=4)))
+                continue
+            journal = self.journals[name]
+            if name in dirty:
+                # the whole map changed, restate it after a clear marker, on a line of its own
+                # in case a failed append left a torn one behind
+                items = list(data.items())
+                lines = "\n" + json.dumps({"c": 1}) + "\n"
+                journal[1] += 1
+            else:
+                # a plain lookup would move the key in an LRUCache, peek at the dict instead
+                items = [(key, dict.get(data, key, MISSING)) for key in changed[name]]
+                lines = ""
+            lines += "".join(json.dumps({"k": key} if value is MISSING else {"k": key, "v": value}) + "\n"
+                             for key, value in items)
+            journal[1] += len(items)
+            jobs.append(("append", journal[0], lines))
+            if journal[1] >= max(self.compact_size, len(data)):
+                # the journal is appended before the snapshot replaces the old one, so a crash
+                # before the truncate only replays entries the snapshot already has
+                jobs.append(("replace", path, json.dumps(data, indent=4)))
+                jobs.append(("replace", journal[0], ""))
+                journal[1] = 0
+        return jobs
+
+    async def flush(self):
+        async with self.lock:
+            jobs = self.snapshot()
+            if jobs and not await asyncio.to_thread(self.write, jobs):
+                self.requeue()
+            self.writing = ({}, set(), set(), {})
+
+    def flush_sync(self):
+        jobs = self.snapshot()
+        if jobs and not self.write(jobs):
+            self.requeue()
+        self.writing = ({}, set(), set(), {})
+
+    def write(self, jobs):
+        for kind, path, content in jobs:
+            try:
+                if kind == "spill":
+                    self.write_spill(*content)
+                elif kind == "replace":
+                    write_json_atomic(path, content)
+                else:
+                    with open(path, "a", encoding="utf-8") as f:
+                        f.write(content)
+            except Exception as e:
+                # the jobs after it are skipped, a journal must not be truncated when the snapshot failed
+                logger.error(f"Failed to persist {path}: {e}")
+                return False
+        return True
+
+    def write_spill(self, spills, cleared):
+        if self.spill_writer is None:
+            if not os.path.exists(self.spill_path) and not any(
+                    value is not MISSING for entries in spills.values() for value in entries.values()):
+                return
+            self.spill_writer = connect_spill(self.spill_path)
+        conn = self.spill_writer
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for name in cleared:
+                conn.execute("DELETE FROM spill WHERE name = ?", (name,))
+            for name, entries in spills.items():
+                conn.executemany("INSERT OR REPLACE INTO spill (name, key, value) VALUES (?, ?, ?)",
+                                 [(name, key, json.dumps(value)) for key, value in entries.items() if value is not MISSING])
+                conn.executemany("DELETE FROM spill WHERE name = ? AND key = ?",
+                                 [(name, key) for key, value in entries.items() if value is MISSING])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    async def flush_forever(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                # a flush already writing finishes even when the loop is cancelled, stop() waits for it on the lock
+                await asyncio.shield(self.flush())
+            except Exception as e:
+                logger.error(f"Failed to flush state: {e}")
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.flush_forever())
+            if self.loading:
+                self.load_task = asyncio.get_running_loop().create_task(self.load())
+            else:
+                self.ready.set()
+
+    async def stop(self):
+        if self.load_task is not None:
+            await self.load_task
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+
+class SqliteStore(MapStore):
+    def __init__(self, db_path, interval=5, threshold=100):
+        # the state table keeps every entry, so it is also where evicted ones are read back from
+        super().__init__(interval, threshold, spill_path=db_path)
+        self.db_path = db_path
+        # highest version this worker has merged, rows above it were written by other workers
+        self.version = None
+        self.db_lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # one row per map entry, a NULL value is a tombstone so deletes reach the other workers
+        self.conn.execute("CREATE TABLE IF NOT EXISTS state (name TEXT NOT NULL, key TEXT NOT NULL, value TEXT, "
+                          "version INTEGER NOT NULL, PRIMARY KEY (name, key)) WITHOUT ROWID")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS state_version ON state (version)")
+        # misses are read on the loop, a second connection keeps them from waiting on a flush in progress
+        self.reader = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+
+    def max_version(self):
+        return self.conn.execute("SELECT COALESCE(MAX(version), 0) FROM state").fetchone()[0]
+
+    def register(self, name, path, getter, journal=False, lines=False, on_sync=None, loader=None, lazy=False):
+        self.maps[name] = (path, getter)
+        if lines:
+            self.lists.add(name)
+        if journal:
+            self.journals[name] = [os.path.splitext(path)[0] + ".journal", 0]
+        self.watch(name, on_sync)
+        self.attach(name, getter())
+        if lazy:
+            self.loading[name] = lambda: self.read(name, loader)
+            return
+        data = getter()
+        loaded = self.read(name, loader or (lambda: data))
+        if loaded is not data:
+            fill(data, loaded)
+
+    def read(self, name, loader):
+        with self.db_lock:
+            # BEGIN IMMEDIATE takes the write lock, so only the first worker imports the files
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self.version is None:
+                    self.version = self.max_version()
+                if self.conn.execute("SELECT 1 FROM state WHERE name = ? LIMIT 1", (name,)).fetchone():
+                    rows = self.conn.execute("SELECT key, value FROM state WHERE name = ? AND value IS NOT NULL "
+                                             "ORDER BY version", (name,)).fetchall()
+                    if name in self.lists:
+                        data = [key for key, value in rows]
+                    else:
+                        data = {key: json.loads(value) for key, value in rows}
+                else:
+                    data = super().read(name, loader())
+                    self.upsert(name, self.encode(name, data), self.max_version() + 1)
+                    logger.info(f"Imported {len(data)} {name} entries into {self.db_path}")
+                self.conn.execute("COMMIT")
+                return data
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def track(self, name, keys):
+        self.changed.setdefault(name, {}).update(dict.fromkeys(keys))
+
+    def spill(self, name, key, value):
+        # the row already holds the entry unless it changed since the last flush
+        if self.is_pending(name, key):
+            self.spilled.setdefault(name, {})[key] = value
+
+    def discard(self, name, key):
+        self.spilled.setdefault(name, {})[key] = MISSING
+
+    def read_spilled(self, name, key):
+        row = self.reader.execute("SELECT value FROM state WHERE name = ? AND key = ? AND value IS NOT NULL",
+                                  (name, key)).fetchone()
+        return json.loads(row[0]) if row else MISSING
+
+    def encode(self, name, data, keys=None, spilled=None):
+        if name in self.lists:
+            items = set(data)
+            return [(key, "1" if key in items else None) for key in (data if keys is None else keys)]
+        # a plain lookup would move the key in an LRUCache while the map is being walked, peek at the dict instead
+        if keys is None:
+            return [(key, json.dumps(value)) for key, value in list(data.items())]
+        rows = []
+        for key in keys:
+            value = dict.get(data, key, MISSING)
+            if value is MISSING and spilled:
+                value = spilled.get(key, MISSING)
+            rows.append((key, json.dumps(value) if value is not MISSING else None))
+        return rows
+
+    def upsert(self, name, rows, version):
+        self.conn.executemany("INSERT INTO state (name, key, value, version) VALUES (?, ?, ?, ?) "
+                              "ON CONFLICT (name, key) DO UPDATE SET value = excluded.value, version = excluded.version",
+                              [(name, key, value, version) for key, value in rows])
+
+    def snapshot(self):
+        dirty, changed = self.take_changes()
+        names = dirty | changed.keys()
+        spills, cleared = self.take_spills(names)
+        self.writing = (spills, cleared, dirty, changed)
+        batch = []
+        for name in names:
+            data = self.maps[name][1]()
+            if isinstance(data, LRUCache):
+                data.evict_expired()
+            entries = spills.get(name, {})
+            if name in dirty:
+                rows = self.encode(name, data)
+                rows += [(key, json.dumps(value)) for key, value in entries.items()
+                         if value is not MISSING and not dict.__contains__(data, key)]
+            else:
+                rows = self.encode(name, data, changed[name], entries)
+            batch.append((name, name in dirty, rows))
+        return batch
+
+    def write(self, batch):
+        if not batch:
+            return True
+        with self.db_lock:
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                # writers are serialized by the lock, so versions commit in order and polling by version misses nothing
+                version = self.max_version() + 1
+                for name, replace, rows in batch:
+                    if replace:
+                        self.conn.execute("UPDATE state SET value = NULL, version = ? WHERE name = ? AND value IS NOT NULL",
+                                          (version, name))
+                    self.upsert(name, rows, version)
+                self.conn.execute("COMMIT")
+                return True
+            except Exception as e:
+                if self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK")
+                logger.error(f"Failed to persist state to {self.db_path}: {e}")
+                return False
+
+    def requeue_changes(self, dirty, changed):
+        # the batch was rolled back, its keys stay pending so merge() keeps the local values until the retry
+        self.dirty |= dirty
+        for name, keys in changed.items():
+            self.changed.setdefault(name, {}).update(keys)
+
+    def poll(self):
+        with self.db_lock:
+            return self.conn.execute("SELECT name, key, value, version FROM state WHERE version > ? ORDER BY version",
+                                     (self.version,)).fetchall()
+
+    def merge(self, rows):
+        for name, key, value, version in rows:
+            self.version = max(self.version, version)
+            if name not in self.maps or self.is_pending(name, key):
+                continue
+            data = self.maps[name][1]()
+            if name in self.lists:
+                if value is not None and key not in data:
+                    data.append(key)
+                elif value is None and key in data:
+                    data.remove(key)
+                else:
+                    continue
+            else:
+                value = json.loads(value) if value is not None else None
+                current = dict.get(data, key, MISSING)
+                if current is MISSING and isinstance(data, LRUCache) and data.backing is not None:
+                    # an evicted entry is read from the database on its next miss anyway
+                    pass
+                elif current == value or current is MISSING and value is None:
+                    continue
+                elif value is None and isinstance(data, LRUCache):
+                    data.remove(key)
+                elif value is None:
+                    data.pop(key)
+                else:
+                    data[key] = value
+            if self.on_sync.get(name):
+                self.on_sync[name](key, value is not None)
+
+    async def flush(self):
+        async with self.lock:
+            batch = self.snapshot()
+            if not await asyncio.to_thread(self.write, batch):
+                self.requeue()
+            self.writing = ({}, set(), set(), {})
+            self.merge(await asyncio.to_thread(self.poll))
+
+    def flush_sync(self):
+        if not self.write(self.snapshot()):
+            self.requeue()
+        self.writing = ({}, set(), set(), {})
+
+
+def create_store(backend, db_path, spill_path, interval=5, threshold=100, compact_size=1000):
+    if backend == "sqlite":
+        return SqliteStore(db_path, interval, threshold)
+    return MapStore(interval, threshold, compact_size, spill_path)
@@ -0,0 +1,82 @@
+import random
+
+
+class TokenRegistry:
+    def __init__(self, tokens=(), error_tokens=()):
+        self.tokens = []
+        self.index = {}
+        self.errors = set()
+        self.cursor = 0
+        self.watchers = []
+        self.rebuild(tokens, error_tokens)
+
+    def rebuild(self, tokens, error_tokens):
+        self.tokens.clear()
+        self.index.clear()
+        self.errors = set(error_tokens)
+        self.cursor = 0
+        for token in tokens:
+            self.add(token)
+
+    def add(self, token):
+        if token in self.index or token in self.errors:
+            return
+        self.index[token] = len(self.tokens)
+        self.tokens.append(token)
+        for watcher in self.watchers:
+            watcher(token)
+
+    def watch(self, watcher):
+        self.watchers.append(watcher)
+
+    def remove(self, token):
+        i = self.index.pop(token, None)
+        if i is None:
+            return
+        # tokens before the cursor were already served this round, keep both halves intact
+        # so removing one never makes round robin skip or repeat another
+        if i < self.cursor:
+            self.cursor -= 1
+            self.move(self.cursor, i)
+            i = self.cursor
+        self.move(len(self.tokens) - 1, i)
+        self.tokens.pop()
+        if self.cursor > len(self.tokens):
+            self.cursor = 0
+
+    def move(self, src, dst):
+        if src != dst:
+            token = self.tokens[src]
+            self.tokens[dst] = token
+            self.index[token] = dst
+
+    def mark_error(self, token):
+        self.errors.add(token)
+        self.remove(token)
+
+    def is_error(self, token):
+        return token in self.errors
+
+    def clear(self):
+        self.rebuild((), ())
+
+    def random(self):
+        return random.choice(self.tokens) if self.tokens else None
+
+    def next(self):
+        if not self.tokens:
+            return None
+        if self.cursor >= len(self.tokens):
+            self.cursor = 0
+        token = self.tokens[self.cursor]
+        self.cursor += 1
+        return token
+
+    def list(self):
+        return list(self.tokens)
+
+    def __contains__(self, token):
+        return token in self.index
+
+    def __len__(self):
+        return len(self.tokens)